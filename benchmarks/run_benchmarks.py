@@ -0,0 +1,380 @@
+"""
+Benchmarks for schema copying, attributes table creation and util functions
+
+Starts two throwaway PostgreSQL instances (initdb in a temporary directory, unix sockets only), generates
+synthetic schemas at several scales and times the parts separately. Results are written as json, so that
+they can be compared between commits.
+
+Usage:
+
+    python benchmarks/run_benchmarks.py --scales small medium --output benchmark.json
+
+Requires the PostgreSQL server binaries (initdb, pg_ctl, psql, pg_dump) and the pg_trgm extension,
+plus the dependencies of this package.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import getpass
+import json
+import os
+import pathlib
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent))
+
+import data_integration.config
+import mara_db.config
+import mara_db.dbs
+import psycopg2
+from data_integration.pipelines import Pipeline, ParallelTask, Task
+from etl_tools import config
+from etl_tools.create_attributes_table import CreateAttributesTable
+from etl_tools.schema_copying import ParallelCopySchema
+
+SCALES = {
+    # tables have between `max_number_of_rows / 32` and `max_number_of_rows` rows
+    'small': {'number_of_tables': 8, 'max_number_of_rows': 100000},
+    'medium': {'number_of_tables': 20, 'max_number_of_rows': 1000000},
+    'large': {'number_of_tables': 40, 'max_number_of_rows': 10000000},
+}
+
+SCHEMA_NAME = 'benchmark'
+
+UTIL_FILES = ['chunking', 'consistency_checks', 'data_sets', 'partitioning',
+              'indexes_and_constraints', 'schema_switching', 'enums']
+
+
+class PostgreSQLInstance:
+    """A PostgreSQL server in a temporary directory that only listens on a unix socket"""
+
+    def __init__(self, bin_dir: pathlib.Path, base_dir: pathlib.Path, name: str, port: int) -> None:
+        self.bin_dir = bin_dir
+        self.data_dir = base_dir / name
+        self.socket_dir = base_dir / (name + '_socket')
+        self.port = port
+        self.user = getpass.getuser()
+
+    def start(self) -> None:
+        self.socket_dir.mkdir()
+        subprocess.run([str(self.bin_dir / 'initdb'), '-D', str(self.data_dir), '-U', self.user,
+                        '--auth=trust', '--encoding=UTF8', '--no-locale'],
+                       check=True, stdout=subprocess.DEVNULL)
+        options = (f"-p {self.port} -k {self.socket_dir} -c listen_addresses='' "
+                   "-c fsync=off -c synchronous_commit=off -c full_page_writes=off -c max_connections=200")
+        subprocess.run([str(self.bin_dir / 'pg_ctl'), '-D', str(self.data_dir), '-l', str(self.data_dir / 'log'),
+                        '-o', options, '-w', 'start'], check=True, stdout=subprocess.DEVNULL)
+        with self.connect('postgres') as connection:
+            connection.autocommit = True
+            connection.cursor().execute('CREATE DATABASE benchmark')
+
+    def stop(self) -> None:
+        subprocess.run([str(self.bin_dir / 'pg_ctl'), '-D', str(self.data_dir), '-m', 'immediate', 'stop'],
+                       stdout=subprocess.DEVNULL)
+
+    def db(self) -> mara_db.dbs.PostgreSQLDB:
+        return mara_db.dbs.PostgreSQLDB(host=str(self.socket_dir), port=self.port, user=self.user,
+                                        database='benchmark')
+
+    def connect(self, database: str = 'benchmark'):
+        return psycopg2.connect(host=str(self.socket_dir), port=self.port, user=self.user, dbname=database)
+
+    def execute(self, sql: str, parameters=None) -> [tuple]:
+        connection = self.connect()
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(sql, parameters)
+                result = cursor.fetchall() if cursor.description else []
+            connection.commit()
+            return result
+        finally:
+            connection.close()
+
+
+def configure(source: PostgreSQLInstance, target: PostgreSQLInstance, number_of_workers: int) -> None:
+    """Points the mara configuration to the throwaway instances"""
+    databases = {'benchmark-source': source.db(), 'benchmark-target': target.db()}
+    mara_db.config.databases = lambda: databases
+    data_integration.config.default_db_alias = lambda: 'benchmark-source'
+    data_integration.config.max_number_of_parallel_tasks = lambda: number_of_workers
+    config.duration_history_db_alias = lambda: 'benchmark-source'
+
+    # the client tools that schema copying runs (psql, pg_dump) need to match the server version
+    os.environ['PATH'] = str(source.bin_dir) + os.pathsep + os.environ.get('PATH', '')
+
+
+def initialize_utils(instance: PostgreSQLInstance) -> float:
+    """Creates the util schema from the files in etl_tools/initialize_utils, returns the duration"""
+    base_path = pathlib.Path(__file__).parent.parent / 'etl_tools' / 'initialize_utils'
+    start_time = time.time()
+    instance.execute('DROP SCHEMA IF EXISTS util CASCADE; CREATE SCHEMA util;')
+    for file_name in UTIL_FILES:
+        instance.execute((base_path / f'{file_name}.sql').read_text()
+                         .replace('number_of_chunks', str(config.number_of_chunks())))
+    return time.time() - start_time
+
+
+def create_synthetic_schema(instance: PostgreSQLInstance, number_of_tables: int, max_number_of_rows: int) -> dict:
+    """Creates tables of different sizes with integer, numeric, text, enum and timestamp columns and indexes"""
+    instance.execute(f'''
+DROP SCHEMA IF EXISTS {SCHEMA_NAME} CASCADE;
+CREATE SCHEMA {SCHEMA_NAME};
+CREATE TYPE {SCHEMA_NAME}.status AS ENUM ('new', 'paid', 'shipped', 'returned', 'cancelled');''')
+
+    for i in range(number_of_tables):
+        number_of_rows = max(1000, max_number_of_rows // 2 ** (i % 6))
+        instance.execute(f'''
+CREATE TABLE {SCHEMA_NAME}.table_{i} (
+  id          BIGINT,
+  customer_id BIGINT,
+  status      {SCHEMA_NAME}.status,
+  country     TEXT,
+  city        TEXT,
+  email       TEXT,
+  amount      NUMERIC,
+  created_at  TIMESTAMP
+);
+
+INSERT INTO {SCHEMA_NAME}.table_{i}
+SELECT n,
+       n % 10000,
+       (enum_range(NULL :: {SCHEMA_NAME}.status)) [1 + n % 5],
+       'country ' || n % 50,
+       'city ' || (n * 7919) % 5000,
+       md5(n :: TEXT) || '@example.com',
+       (n % 100000) / 100.0,
+       TIMESTAMP '2020-01-01' + n * INTERVAL '1 minute'
+FROM generate_series(1, {number_of_rows}) n;
+
+ALTER TABLE {SCHEMA_NAME}.table_{i} ADD PRIMARY KEY (id);
+CREATE INDEX table_{i}__customer_id ON {SCHEMA_NAME}.table_{i} (customer_id);
+CREATE INDEX table_{i}__country_created_at ON {SCHEMA_NAME}.table_{i} (country, created_at);
+ANALYZE {SCHEMA_NAME}.table_{i};''')
+
+    (number_of_rows, size), = instance.execute('''
+SELECT sum(reltuples) :: BIGINT, sum(pg_table_size(pg_class.oid)) / 1000000.0
+FROM pg_class
+  JOIN pg_namespace ON pg_namespace.oid = relnamespace
+WHERE nspname = %s AND relkind = 'r' ''', (SCHEMA_NAME,))
+    return {'number_of_tables': number_of_tables, 'number_of_rows': number_of_rows, 'table_size_mb': float(size)}
+
+
+def run_parallel_task(task: ParallelTask, number_of_workers: int) -> {str: (float, float)}:
+    """
+    Runs the sub tasks of a parallel task in topological order with a thread pool
+
+    Returns:
+        For each sub task its start and end time relative to the start of the first task
+    """
+    sub_pipeline = Pipeline(id=task.id, description=task.description)
+    task.add_parallel_tasks(sub_pipeline)
+    start_time = time.time()
+
+    def run_node(node: Task) -> (bool, float, float):
+        node_start_time = time.time()
+        succeeded = node.run()
+        return succeeded, node_start_time - start_time, time.time() - start_time
+
+    remaining_nodes = dict(sub_pipeline.nodes)
+    finished_node_ids = set()
+    timings = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=number_of_workers) as executor:
+        running = {}
+        while remaining_nodes or running:
+            for node_id, node in list(remaining_nodes.items()):
+                if len(running) < number_of_workers \
+                        and all(upstream.id in finished_node_ids for upstream in node.upstreams):
+                    running[executor.submit(run_node, node)] = node
+                    del remaining_nodes[node_id]
+            if not running:
+                raise RuntimeError(f'Can not run {", ".join(remaining_nodes)}: upstreams are not satisfiable')
+
+            done, _pending = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                succeeded, node_start, node_end = future.result()
+                if not succeeded:
+                    raise RuntimeError(f'Task {node.id} failed')
+                timings[node.id] = (node_start, node_end)
+                finished_node_ids.add(node.id)
+    return timings
+
+
+def phases(timings: {str: (float, float)}, prefixes: {str: str}) -> dict:
+    """Summarizes task timings by phase (tasks whose id starts with a prefix): wall time and sum of durations"""
+    result = {'total_duration': max((end for _start, end in timings.values()), default=0)}
+    for phase, prefix in prefixes.items():
+        phase_timings = [(start, end) for task_id, (start, end) in timings.items() if task_id.startswith(prefix)]
+        if phase_timings:
+            result[phase] = {'number_of_tasks': len(phase_timings),
+                             'wall_time': max(end for _start, end in phase_timings)
+                                          - min(start for start, _end in phase_timings),
+                             'sum_of_durations': sum(end - start for start, end in phase_timings)}
+    return result
+
+
+def repeated(function, number_of_runs: int) -> dict:
+    """Runs a function several times, returns all results and the median of their `total_duration`"""
+    runs = [function() for _run in range(number_of_runs)]
+    return {'median_duration': statistics.median(run['total_duration'] for run in runs), 'runs': runs}
+
+
+def benchmark_schema_copying(target: PostgreSQLInstance, schema: dict, number_of_workers: int,
+                             number_of_runs: int) -> dict:
+    prefixes = {'copy': 'copy_tables', 'index': 'add_indexes'}
+    variants = {'text': {},
+                'binary': {'binary_copy': True},
+                'binary_sliced': {'binary_copy': True,
+                                  'max_table_slice_size': max(schema['table_size_mb'] / number_of_workers / 4, 1)}}
+
+    def copy(**options):
+        timings = run_parallel_task(
+            ParallelCopySchema(id='copy_schema', description='Copies the benchmark schema',
+                               max_number_of_parallel_tasks=number_of_workers,
+                               source_db_alias='benchmark-source', target_db_alias='benchmark-target',
+                               schema_name=SCHEMA_NAME, use_duration_history=False, **options),
+            number_of_workers)
+        result = phases(timings, prefixes)
+        if 'copy' in result:
+            result['copy']['mb_per_second'] = schema['table_size_mb'] / max(result['copy']['wall_time'], 0.001)
+            result['copy']['rows_per_second'] = schema['number_of_rows'] / max(result['copy']['wall_time'], 0.001)
+        return result
+
+    results = {name: repeated(lambda: copy(**options), number_of_runs) for name, options in variants.items()}
+
+    # a first incremental copy into an empty target, then copies without changes
+    target.execute(f'DROP SCHEMA IF EXISTS {SCHEMA_NAME} CASCADE')
+    results['incremental_initial'] = copy(incremental=True)
+    results['incremental_unchanged'] = repeated(lambda: copy(incremental=True), number_of_runs)
+
+    def reindex():
+        start_time = time.time()
+        target.execute(f'REINDEX SCHEMA {SCHEMA_NAME}')
+        return {'total_duration': time.time() - start_time}
+
+    results['reindex_schema'] = repeated(reindex, number_of_runs)
+    return results
+
+
+def benchmark_attributes_table(number_of_workers: int, number_of_runs: int) -> dict:
+    variants = {'default': {}, 'single_scan': {'single_scan': True}}
+
+    def create(table_name: str, **options):
+        timings = run_parallel_task(
+            CreateAttributesTable(id='create_attributes_table', source_schema_name=SCHEMA_NAME,
+                                  source_table_name=table_name, db_alias='benchmark-source',
+                                  max_number_of_parallel_tasks=number_of_workers, **options),
+            number_of_workers)
+        return phases(timings, {'scan': 'scan_', 'create_table': 'create_table'})
+
+    results = {}
+    # table_0 is the biggest table, table_3 has an eighth of its rows
+    for table_name in ['table_0', 'table_3']:
+        results[table_name] = {name: repeated(lambda: create(table_name, **options), number_of_runs)
+                               for name, options in variants.items()}
+        results[table_name]['incremental_initial'] = create(table_name, incremental=True)
+        results[table_name]['incremental_unchanged'] = repeated(lambda: create(table_name, incremental=True),
+                                                                number_of_runs)
+    return results
+
+
+def benchmark_util_functions(source: PostgreSQLInstance, number_of_runs: int, number_of_calls: int = 100) -> dict:
+    def timed(sql: str, parameters=None, calls: int = 1):
+        def run():
+            start_time = time.time()
+            for _call in range(calls):
+                source.execute(sql, parameters)
+            duration = time.time() - start_time
+            return {'total_duration': duration, 'duration_per_call': duration / calls}
+
+        return repeated(run, number_of_runs)
+
+    table_name = f'{SCHEMA_NAME}.table_0'
+    results = {
+        'baseline_scan': timed(f'SELECT sum(abs(id) % 7) FROM {table_name}'),
+        'compute_chunk_bigint': timed(f'SELECT sum(util.compute_chunk(id)) FROM {table_name}'),
+        'compute_chunk_text': timed(f'SELECT sum(util.compute_chunk(email)) FROM {table_name}'),
+        'add_existing_index': timed(
+            "SELECT util.add_index(%s, 'table_0', column_names := ARRAY ['customer_id'])",
+            (SCHEMA_NAME,), calls=number_of_calls),
+        'assert_equal': timed("SELECT util.assert_equal('benchmark', 'SELECT 1', 'SELECT 1')",
+                              calls=number_of_calls),
+    }
+
+    source.execute(f'''
+DROP TABLE IF EXISTS {SCHEMA_NAME}.partitioned;
+CREATE TABLE {SCHEMA_NAME}.partitioned (key INTEGER, value TEXT) PARTITION BY LIST (key);''')
+    start_time = time.time()
+    source.execute("SELECT util.create_table_partitions(%s, 'partitioned', 'SELECT generate_series(0, 999)')",
+                   (SCHEMA_NAME,))
+    results['create_1000_table_partitions'] = {'total_duration': time.time() - start_time}
+    results['create_table_partitions_existing'] = timed(
+        "SELECT util.create_table_partitions(%s, 'partitioned', 'SELECT generate_series(0, 999)')",
+        (SCHEMA_NAME,))
+    return results
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=str(pathlib.Path(__file__).parent),
+                              stdout=subprocess.PIPE, check=True).stdout.decode().strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', nargs='+', choices=SCALES.keys(), default=['small'])
+    parser.add_argument('--output', help='The json file to write the results to (default: stdout)')
+    parser.add_argument('--workers', type=int, default=4, help='How many tasks to run in parallel')
+    parser.add_argument('--runs', type=int, default=3, help='How often to repeat each measurement')
+    parser.add_argument('--bin-dir', help='The directory of the PostgreSQL binaries (default: from pg_config)')
+    args = parser.parse_args()
+
+    bin_dir = pathlib.Path(args.bin_dir or subprocess.run(['pg_config', '--bindir'], stdout=subprocess.PIPE,
+                                                          check=True).stdout.decode().strip())
+    results = {'commit': git_commit(), 'started_at': datetime.datetime.now().isoformat(),
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'workers': args.workers, 'runs': args.runs, 'scales': {}}
+
+    with tempfile.TemporaryDirectory(prefix='etl_tools_benchmark_') as base_dir:
+        source = PostgreSQLInstance(bin_dir, pathlib.Path(base_dir), 'source', 54321)
+        target = PostgreSQLInstance(bin_dir, pathlib.Path(base_dir), 'target', 54322)
+        try:
+            source.start()
+            target.start()
+            configure(source, target, args.workers)
+            results['postgresql'] = source.execute('SHOW server_version')[0][0]
+            results['initialize_utils'] = initialize_utils(source)
+            initialize_utils(target)
+
+            for scale in args.scales:
+                print(f'{scale}: creating schema', file=sys.stderr)
+                schema = create_synthetic_schema(source, **SCALES[scale])
+                print(f'{scale}: schema copying', file=sys.stderr)
+                copying = benchmark_schema_copying(target, schema, args.workers, args.runs)
+                print(f'{scale}: attributes tables', file=sys.stderr)
+                attributes = benchmark_attributes_table(args.workers, args.runs)
+                print(f'{scale}: util functions', file=sys.stderr)
+                util_functions = benchmark_util_functions(source, args.runs)
+                results['scales'][scale] = {'schema': schema, 'schema_copying': copying,
+                                            'attributes_table': attributes, 'util_functions': util_functions}
+        finally:
+            source.stop()
+            target.stop()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        pathlib.Path(args.output).write_text(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
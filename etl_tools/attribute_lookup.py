@@ -0,0 +1,262 @@
+"""Fast auto-completion on attributes tables that were created with `CreateAttributesTable`"""
+
+import bisect
+import collections
+import heapq
+import re
+import threading
+import time
+import weakref
+
+import data_integration.config
+import psycopg2.errors
+from etl_tools import config
+from etl_tools.connection_pooling import pooled_cursor_context
+
+
+def lookup(schema_name: str, table_name: str, attribute: str, prefix: str, limit: int = 10,
+           db_alias: str = None, attributes_table_suffix: str = '_attributes') -> [(str, int)]:
+    """
+    Returns the most frequent values of an attribute that start with a prefix (case insensitive)
+
+    Example:
+        >>> lookup('foo', 'bar', 'b', 'x')
+        [('x', 2)]
+
+    Results are cached in memory. Attributes with few values are loaded completely into memory and looked up
+    there. The cache is invalidated when partitions of the attributes table are replaced.
+
+    Args:
+        schema_name: The schema of the original table, e.g. 'foo'
+        table_name: The name of the original table, e.g. 'bar'
+        attribute: The column of the original table
+        prefix: The beginning of the value
+        limit: How many values to return at most
+        db_alias: The database of the attributes table
+        attributes_table_suffix: The suffix of the attributes table, see `CreateAttributesTable`
+
+    Returns:
+        A list of `(value, row_count)` tuples, sorted by descending row count
+    """
+    start_time = time.time()
+    db_alias = db_alias or data_integration.config.default_db_alias()
+    prefix = prefix.lower()
+
+    for attempt in range(2):
+        table = _attributes_table(db_alias, f'{schema_name}.{table_name}{attributes_table_suffix}')
+
+        key = (db_alias, table.name, table.version, attribute, prefix, limit)
+        result = _cache.get(key)
+        if result is not None:
+            _count('cache_hits', start_time)
+            return result
+
+        partition = table.partitions.get(attribute)
+        try:
+            if not partition:
+                result = []
+                kind = 'unknown_attributes'
+            elif partition.in_memory:
+                result = partition.prefix_index(db_alias).lookup(prefix, limit)
+                kind = 'in_memory_lookups'
+            else:
+                result = _query_partition(db_alias, partition, prefix, limit)
+                kind = 'database_queries'
+        except psycopg2.errors.UndefinedTable:
+            # the partition was replaced after the last version check: reload the partitions and try once more
+            if attempt:
+                raise
+            invalidate()
+            continue
+
+        _count(kind, start_time)
+        _cache.put(key, result)
+        return result
+
+
+def invalidate() -> None:
+    """Removes all cached results and attributes table metadata, e.g. after rebuilding attributes tables"""
+    with _attributes_tables_lock:
+        _attributes_tables.clear()
+    _cache.clear()
+
+
+def statistics() -> {str: float}:
+    """Returns the number of lookups by kind and their latencies (in milliseconds)"""
+    with _statistics_lock:
+        result = dict(_statistics)
+    result['cache_size'] = len(_cache)
+    if result['lookups']:
+        result['average_latency'] = result['total_latency'] / result['lookups']
+    return result
+
+
+def reset_statistics() -> None:
+    """Sets all counters to zero"""
+    with _statistics_lock:
+        _statistics.clear()
+        _statistics.update({'lookups': 0, 'cache_hits': 0, 'in_memory_lookups': 0, 'database_queries': 0,
+                            'unknown_attributes': 0, 'total_latency': 0.0, 'max_latency': 0.0})
+
+
+class _ResultCache:
+    """A thread safe least-recently-used cache with a time to live for its entries"""
+
+    def __init__(self) -> None:
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if time.time() - stored_at > config.attribute_lookup_cache_ttl():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > config.attribute_lookup_cache_size():
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class _PrefixIndex:
+    """All values of an attribute, sorted by their lower case version for finding values by prefix with bisect"""
+
+    def __init__(self, values: [(str, int)]) -> None:
+        values = sorted((value.lower(), value, row_count) for value, row_count in values)
+        self.keys = [key for key, _value, _row_count in values]
+        self.values = [(value, row_count) for _key, value, row_count in values]
+
+    def lookup(self, prefix: str, limit: int) -> [(str, int)]:
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + '\U0010ffff', lo=start)
+        return heapq.nlargest(limit, self.values[start:end], key=lambda value: (value[1], value[0]))
+
+
+class _Partition:
+    """The list partition of an attributes table that contains the values of one attribute"""
+
+    def __init__(self, oid: int, name: str, number_of_values: int = None) -> None:
+        self.oid = oid
+        self.name = name
+        # partitions with an unknown number of values are queried in the database
+        self.in_memory = (number_of_values is not None
+                          and number_of_values <= config.attribute_lookup_max_number_of_in_memory_values())
+        self._prefix_index = None
+        self._lock = threading.Lock()
+
+    def prefix_index(self, db_alias: str) -> _PrefixIndex:
+        with self._lock:
+            if not self._prefix_index:
+                with pooled_cursor_context(db_alias) as cursor:  # type: psycopg2.extensions.cursor
+                    cursor.execute(f'SELECT value, row_count FROM {self.name}')
+                    self._prefix_index = _PrefixIndex(cursor.fetchall())
+            return self._prefix_index
+
+
+class _AttributesTable:
+    """The partitions of an attributes table. The version changes whenever a partition is replaced"""
+
+    def __init__(self, name: str, partitions: {str: _Partition}) -> None:
+        self.name = name
+        self.partitions = partitions
+        self.version = tuple(sorted(partition.oid for partition in partitions.values()))
+        self.checked_at = time.time()
+
+
+def _attributes_table(db_alias: str, name: str) -> _AttributesTable:
+    """Returns the (cached) partitions of an attributes table, reloads them when the check interval passed"""
+    key = (db_alias, name)
+    with _attributes_tables_lock:
+        table = _attributes_tables.get(key)
+    if table and time.time() - table.checked_at < config.attribute_lookup_version_check_interval():
+        return table
+
+    with pooled_cursor_context(db_alias) as cursor:  # type: psycopg2.extensions.cursor
+        # `reltuples` is -1 (PostgreSQL >= 14) or 0 for tables that were not analyzed yet
+        cursor.execute('''
+SELECT child.oid, child.oid :: REGCLASS :: TEXT, pg_get_expr(child.relpartbound, child.oid),
+       CASE WHEN child.reltuples > 0 THEN child.reltuples END
+FROM pg_inherits
+  JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+WHERE inhparent = to_regclass(%s)''', (name,))
+        partitions = {}
+        for oid, partition_name, partition_bound, number_of_values in cursor.fetchall():
+            match = re.fullmatch(r"FOR VALUES IN \('(.*)'\)", partition_bound or '')
+            if match:
+                partitions[match.group(1).replace("''", "'")] = _Partition(oid, partition_name, number_of_values)
+
+    new_table = _AttributesTable(name, partitions)
+    if table and table.version == new_table.version:
+        # keep the loaded prefix indexes
+        table.checked_at = new_table.checked_at
+        return table
+
+    with _attributes_tables_lock:
+        _attributes_tables[key] = new_table
+    return new_table
+
+
+def _query_partition(db_alias: str, partition: _Partition, prefix: str, limit: int) -> [(str, int)]:
+    """
+    Queries a partition with a statement that is prepared once per connection and partition.
+    Statements of partitions that were replaced in the meantime are deallocated before preparing a new one.
+    """
+    statement_name = f'attribute_lookup_{partition.oid}'
+    pattern = re.sub(r'([%_\\])', r'\\\1', prefix) + '%'
+    with pooled_cursor_context(db_alias) as cursor:  # type: psycopg2.extensions.cursor
+        prepared_statements = _prepared_statements.setdefault(cursor.connection, set())
+        if statement_name not in prepared_statements:
+            with _attributes_tables_lock:
+                current_statement_names = {f'attribute_lookup_{oid}'
+                                           for table in _attributes_tables.values() for oid in table.version}
+            for stale_statement_name in prepared_statements - current_statement_names:
+                cursor.execute(f'DEALLOCATE {stale_statement_name}')
+                prepared_statements.discard(stale_statement_name)
+
+            cursor.execute(f'''
+PREPARE {statement_name} (TEXT, INTEGER) AS
+SELECT value, row_count
+FROM {partition.name}
+WHERE value ILIKE $1
+ORDER BY row_count DESC, value DESC
+LIMIT $2''')
+            prepared_statements.add(statement_name)
+        cursor.execute(f'EXECUTE {statement_name} (%s, %s)', (pattern, limit))
+        return cursor.fetchall()
+
+
+def _count(kind: str, start_time: float) -> None:
+    latency = (time.time() - start_time) * 1000
+    with _statistics_lock:
+        _statistics['lookups'] += 1
+        _statistics[kind] += 1
+        _statistics['total_latency'] += latency
+        _statistics['max_latency'] = max(_statistics['max_latency'], latency)
+
+
+_cache = _ResultCache()
+
+_attributes_tables = {}
+_attributes_tables_lock = threading.Lock()
+
+# the names of the statements that were prepared on each pooled connection
+_prepared_statements = weakref.WeakKeyDictionary()
+
+_statistics = {}
+_statistics_lock = threading.Lock()
+reset_statistics()
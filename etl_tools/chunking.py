@@ -0,0 +1,257 @@
+"""Client side computation of chunks (identical to `util.compute_chunk` from initialize_utils/chunking.sql)
+and loading of rows directly into chunk partitions"""
+
+import hashlib
+import json
+import threading
+import time
+
+import mara_db.postgresql
+import psycopg2.extras
+from data_integration.logging import logger
+from data_integration.pipelines import Command
+from etl_tools import config
+from etl_tools.streaming_copy import BoundedBuffer
+from mara_page import _, html
+
+
+def compute_chunk(key, number_of_chunks: int = None) -> int:
+    """
+    Returns the chunk of a key, like `util.compute_chunk(BIGINT)` for integers and `util.compute_chunk(TEXT)`
+    for strings. `None` is in chunk 0.
+
+    Args:
+        key: An integer or a string
+        number_of_chunks: The number of chunks, defaults to `config.number_of_chunks()`
+    """
+    number_of_chunks = number_of_chunks or config.number_of_chunks()
+    if key is None:
+        return 0
+    if isinstance(key, str):
+        value = int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:4], 'big', signed=True)
+        if value == -2 ** 31:  # abs() of INT fails in PostgreSQL
+            raise ValueError('integer out of range')
+    else:
+        value = int(key)
+        if not -2 ** 63 < value < 2 ** 63:  # abs() of BIGINT fails in PostgreSQL
+            raise ValueError('bigint out of range')
+    return abs(value) % number_of_chunks
+
+
+def compute_chunks(keys, number_of_chunks: int = None):
+    """
+    Vectorized version of `compute_chunk`: returns the chunks of a list or numpy array of keys (requires numpy).
+    All keys that are not `None` must be either integers or strings.
+
+    Args:
+        keys: The keys to compute the chunks of
+        number_of_chunks: The number of chunks, defaults to `config.number_of_chunks()`
+
+    Returns:
+        A numpy array with the chunk of each key
+    """
+    import numpy
+
+    number_of_chunks = number_of_chunks or config.number_of_chunks()
+
+    if isinstance(keys, numpy.ndarray) and keys.dtype.kind in 'iu':
+        # unsigned keys above the BIGINT range would wrap around when cast
+        if keys.dtype.kind == 'u' and keys.size and keys.max() > numpy.iinfo(numpy.int64).max:
+            raise ValueError('bigint out of range')
+        values = keys.astype(numpy.int64)
+        if (values == numpy.iinfo(numpy.int64).min).any():
+            raise ValueError('bigint out of range')
+        return numpy.abs(values) % number_of_chunks
+
+    keys = list(keys)
+    is_null = numpy.fromiter((key is None for key in keys), dtype=bool, count=len(keys))
+    first_key = next((key for key in keys if key is not None), None)
+
+    if isinstance(first_key, str):
+        # the first 4 bytes of the md5 hash as big endian signed 32 bit integer, like `('x' || ..) :: BIT(32) :: INT`
+        digests = b''.join(b'\0\0\0\0' if key is None else hashlib.md5(key.encode('utf-8')).digest()[:4]
+                           for key in keys)
+        values = numpy.frombuffer(digests, dtype='>i4').astype(numpy.int64)
+        if (values == -2 ** 31).any():
+            raise ValueError('integer out of range')
+    else:
+        try:
+            values = numpy.fromiter((0 if key is None else key for key in keys), dtype=numpy.int64, count=len(keys))
+        except OverflowError:
+            raise ValueError('bigint out of range')
+        if (values == numpy.iinfo(numpy.int64).min).any():
+            raise ValueError('bigint out of range')
+
+    chunks = numpy.abs(values) % number_of_chunks
+    chunks[is_null] = 0
+    return chunks
+
+
+def copy_rows_into_chunks(db_alias: str, target_table: str, rows, key_column_index: int,
+                          column_names: [str] = None, number_of_chunks: int = None,
+                          batch_size: int = 10000) -> int:
+    """
+    Writes rows into the chunk partitions `<target_table>_<chunk>` of a table (see `util.create_table_partitions`).
+    Rows are routed to chunks client side, and each chunk partition is written with its own
+    `COPY .. FROM STDIN` in parallel. Requires numpy.
+
+    The load is not atomic: each chunk partition is written in its own transaction. When reading the rows or a
+    `COPY` fails, then all `COPY`s that are still running are aborted, but chunks whose `COPY` already finished
+    stay loaded. For all-or-nothing loads, write into empty tables that are swapped in afterwards.
+
+    Args:
+        db_alias: The database of the target table
+        target_table: The partitioned table, e.g. 'foo.bar'
+        rows: An iterable of tuples. Values are written in their PostgreSQL text representation (see
+              `_copy_value`), lists are written as arrays: pass json arrays as json strings
+        key_column_index: The position of the column in each row that the chunk is computed from
+        column_names: The columns of the target table to write to, defaults to all columns
+        number_of_chunks: The number of chunks, defaults to `config.number_of_chunks()`
+        batch_size: For how many rows at once to compute chunks
+
+    Returns:
+        The number of rows written
+    """
+    number_of_chunks = number_of_chunks or config.number_of_chunks()
+    columns = f' ({", ".join(column_names)})' if column_names else ''
+
+    buffers = [BoundedBuffer() for _chunk in range(number_of_chunks)]
+    errors = []
+
+    def copy_chunk(chunk: int):
+        try:
+            with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:  # type: psycopg2.extensions.cursor
+                cursor.copy_expert(f'COPY {target_table}_{chunk}{columns} FROM STDIN', buffers[chunk])
+        except Exception as e:
+            errors.append(e)
+            buffers[chunk].abort()
+
+    threads = [threading.Thread(target=copy_chunk, args=(chunk,), daemon=True) for chunk in range(number_of_chunks)]
+    for thread in threads:
+        thread.start()
+
+    number_of_rows = 0
+    try:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                _write_batch(batch, key_column_index, number_of_chunks, buffers)
+                number_of_rows += len(batch)
+                batch = []
+        if batch:
+            _write_batch(batch, key_column_index, number_of_chunks, buffers)
+            number_of_rows += len(batch)
+    except Exception as e:
+        for buffer in buffers:
+            buffer.close_writing(error=e)
+        for thread in threads:
+            thread.join()
+        if errors:  # writing failed because a COPY failed
+            raise errors[0]
+        raise
+    else:
+        for buffer in buffers:
+            buffer.close_writing()
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return number_of_rows
+
+
+def _write_batch(batch: [tuple], key_column_index: int, number_of_chunks: int, buffers: [BoundedBuffer]) -> None:
+    chunks = compute_chunks([row[key_column_index] for row in batch], number_of_chunks)
+    lines = [[] for _chunk in range(number_of_chunks)]
+    for row, chunk in zip(batch, chunks.tolist()):
+        lines[chunk].append(_copy_line(row))
+    for chunk, chunk_lines in enumerate(lines):
+        if chunk_lines:
+            buffers[chunk].write(''.join(chunk_lines))
+
+
+def _copy_line(row: tuple) -> str:
+    """Formats a row in the text format of `COPY`"""
+    return '\t'.join('\\N' if value is None
+                     else _copy_value(value).replace('\\', '\\\\').replace('\t', '\\t')
+                                            .replace('\n', '\\n').replace('\r', '\\r')
+                     for value in row) + '\n'
+
+
+def _copy_value(value) -> str:
+    """
+    The PostgreSQL text representation of a value that is not `None`: booleans as `t` / `f`, bytes as hex bytea,
+    dicts as json and lists and tuples as array literals
+    """
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + bytes(value).hex()
+    if isinstance(value, dict):
+        return json.dumps(value)
+    if isinstance(value, (list, tuple)):
+        return '{' + ','.join('NULL' if element is None
+                              else _copy_value(element) if isinstance(element, (list, tuple))
+                              else '"' + _copy_value(element).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                              for element in value) + '}'
+    return str(value)
+
+
+class ChunkedCopy(Command):
+    def __init__(self, source_db_alias: str, source_query: str, target_db_alias: str, target_table: str,
+                 key_column_index: int = 0, column_names: [str] = None, number_of_chunks: int = None) -> None:
+        """
+        Copies the result of a query into the chunk partitions of a table, computing chunks client side
+        (see `copy_rows_into_chunks`)
+
+        Args:
+            source_db_alias: The database to run the query in
+            source_query: The query that returns the rows to copy
+            target_db_alias: The database of the target table
+            target_table: The partitioned table, e.g. 'foo.bar'
+            key_column_index: The position of the column in the query result that the chunk is computed from
+            column_names: The columns of the target table to write to, defaults to all columns
+            number_of_chunks: The number of chunks, defaults to `config.number_of_chunks()`
+        """
+        super().__init__()
+        self.source_db_alias = source_db_alias
+        self.source_query = source_query
+        self.target_db_alias = target_db_alias
+        self.target_table = target_table
+        self.key_column_index = key_column_index
+        self.column_names = column_names
+        self.number_of_chunks = number_of_chunks
+
+    def run(self) -> bool:
+        start_time = time.time()
+        try:
+            with mara_db.postgresql.postgres_cursor_context(
+                    self.source_db_alias) as cursor:  # type: psycopg2.extensions.cursor
+                # json values are passed through as text (json arrays would otherwise be written as arrays)
+                psycopg2.extras.register_default_json(cursor.connection, loads=lambda value: value)
+                psycopg2.extras.register_default_jsonb(cursor.connection, loads=lambda value: value)
+                # server side cursor for not reading the whole result into memory
+                source_cursor = cursor.connection.cursor(name='chunked_copy')
+                source_cursor.itersize = 10000
+                source_cursor.execute(self.source_query)
+                number_of_rows = copy_rows_into_chunks(self.target_db_alias, self.target_table, source_cursor,
+                                                       self.key_column_index, self.column_names,
+                                                       self.number_of_chunks)
+                source_cursor.close()
+        except Exception as e:
+            logger.log(f'Copying into {self.target_table} failed: {e}', is_error=True, format=logger.Format.VERBATIM)
+            return False
+
+        duration = max(time.time() - start_time, 0.001)
+        logger.log(f'{self.target_table}: {number_of_rows} rows in {duration:.1f} s '
+                   f'({number_of_rows / duration:.0f} rows/s)', format=logger.Format.ITALICS)
+        return True
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('source db', _.tt[self.source_db_alias]),
+                ('source query', html.highlight_syntax(self.source_query, 'sql')),
+                ('target db', _.tt[self.target_db_alias]),
+                ('target table', _.tt[self.target_table]),
+                ('key column index', _.tt[self.key_column_index]),
+                ('number of chunks', _.tt[self.number_of_chunks or config.number_of_chunks()])]
@@ -16,3 +16,43 @@ def last_date_in_time_dimensions() -> datetime.date:
 def number_of_chunks() -> int:
     """Big tables and computations are split into this many chunks"""
     return 7
+
+
+def duration_history_db_alias() -> str:
+    """The database in which the durations of copy and index operations are stored for scheduling later runs"""
+    return 'mara'
+
+
+def attribute_lookup_cache_size() -> int:
+    """How many auto-completion results to keep at most in memory"""
+    return 10000
+
+
+def attribute_lookup_cache_ttl() -> float:
+    """How long to keep auto-completion results in memory (in seconds)"""
+    return 300
+
+
+def attribute_lookup_version_check_interval() -> float:
+    """How often to check whether an attributes table was rebuilt (in seconds)"""
+    return 10
+
+
+def attribute_lookup_max_number_of_in_memory_values() -> int:
+    """Attributes with at most this many values are completely loaded into memory for auto-completion"""
+    return 10000
+
+
+def euro_exchange_rates_source() -> str:
+    """The url or local file of the (zipped) csv file with historic Euro exchange rates"""
+    return 'https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip'
+
+
+def metrics_db_alias() -> str:
+    """The database in which the metrics of parallel tasks are stored (`None` for not storing them in a database)"""
+    return 'mara'
+
+
+def metrics_file() -> str:
+    """A file to which the metrics of parallel tasks are appended as json lines (`None` for no file)"""
+    return None
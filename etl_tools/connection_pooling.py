@@ -0,0 +1,51 @@
+"""Pooled PostgreSQL connections for running many queries from within the same process"""
+
+import contextlib
+import os
+import threading
+
+import mara_db.dbs
+import psycopg2.extensions
+import psycopg2.pool
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def connection_pool(db_alias: str, max_number_of_connections: int = 10) -> psycopg2.pool.ThreadedConnectionPool:
+    """
+    Returns a thread safe connection pool for a database alias.
+
+    Pools are created lazily and per process, because connections must not be shared with forked child processes.
+    """
+    key = (os.getpid(), db_alias)
+    with _pools_lock:
+        if key not in _pools:
+            db = mara_db.dbs.db(db_alias)
+            assert (isinstance(db, mara_db.dbs.PostgreSQLDB))
+            _pools[key] = psycopg2.pool.ThreadedConnectionPool(
+                0, max_number_of_connections,
+                dbname=db.database, user=db.user, password=db.password, host=db.host, port=db.port)
+        return _pools[key]
+
+
+@contextlib.contextmanager
+def pooled_cursor_context(db_alias: str) -> psycopg2.extensions.cursor:
+    """
+    Like `mara_db.postgresql.postgres_cursor_context`, but takes the connection from a pool and returns it afterwards.
+    Commits on success, rolls back on exceptions.
+    """
+    pool = connection_pool(db_alias)
+    connection = pool.getconn()
+    cursor = connection.cursor()
+    try:
+        yield cursor
+        connection.commit()
+    except Exception:
+        if not connection.closed:
+            connection.rollback()
+        raise
+    finally:
+        if not cursor.closed:
+            cursor.close()
+        pool.putconn(connection, close=bool(connection.closed))
@@ -0,0 +1,222 @@
+"""Consistency checks that compute all aggregates of the same table in one scan"""
+
+import operator
+import re
+import time
+
+import data_integration.config
+import mara_db.postgresql
+from data_integration.commands.sql import ExecuteSQL
+from data_integration.logging import logger
+from data_integration.pipelines import Command, Pipeline, ParallelTask, Task
+from mara_page import _, html
+
+RELATIONS = {'=': operator.eq, '<>': operator.ne, '<': operator.lt, '<=': operator.le,
+             '>': operator.gt, '>=': operator.ge}
+
+
+class Aggregate:
+    def __init__(self, table_name: str, expression: str, condition: str = None) -> None:
+        """
+        An aggregate on a table, e.g. `Aggregate('dim.order', 'count(*)', condition='customer_fk IS NULL')`
+
+        Args:
+            table_name: The table to aggregate, e.g. 'dim.order'
+            expression: An aggregate function, e.g. 'count(*)' or 'sum(revenue)'
+            condition: When given, then only rows that satisfy this condition are aggregated (`FILTER (WHERE ..)`)
+        """
+        self.table_name = table_name
+        self.expression = expression
+        self.condition = condition
+
+    def sql(self) -> str:
+        return self.expression + (f' FILTER (WHERE {self.condition})' if self.condition else '')
+
+    def __str__(self) -> str:
+        return f'{self.sql()} ON {self.table_name}'
+
+
+class Check:
+    def __init__(self, description: str, aggregate: Aggregate, relation: str, value,
+                 tolerance: float = 0) -> None:
+        """
+        A check that compares an aggregate with a number or another aggregate
+
+        Example:
+            Check('All orders have a customer',
+                  Aggregate('dim.order', 'count(*)', condition='customer_fk IS NULL'), '=', 0)
+
+        Args:
+            description: What is checked
+            aggregate: The aggregate to check
+            relation: How the aggregate is compared to the value, one of `=`, `<>`, `<`, `<=`, `>`, `>=`
+            value: A number or another `Aggregate`
+            tolerance: For `=`, the relative difference that is still accepted (e.g. 0.01 for 1%)
+        """
+        assert relation in RELATIONS, f'Unknown relation "{relation}"'
+        self.description = description
+        self.aggregate = aggregate
+        self.relation = relation
+        self.value = value
+        self.tolerance = tolerance
+
+    def aggregates(self) -> [Aggregate]:
+        return [self.aggregate] + ([self.value] if isinstance(self.value, Aggregate) else [])
+
+    def succeeded(self, result, value) -> bool:
+        if result is None or value is None:
+            return result is None and value is None and self.relation in ('=', '<=', '>=')
+        if self.relation == '=' and self.tolerance:
+            return abs(float(result) - float(value)) <= self.tolerance * max(abs(float(result)), abs(float(value)))
+        return RELATIONS[self.relation](result, value)
+
+    def __str__(self) -> str:
+        return f'{self.aggregate} {self.relation} {self.value}'
+
+
+class RunConsistencyChecks(ParallelTask):
+    def __init__(self, id: str, checks: [Check], db_alias: str = None,
+                 max_number_of_parallel_tasks: int = None) -> None:
+        """
+        Runs consistency checks. All aggregates of a table are computed in a single query (one scan of the
+        table), and the queries of different tables run in parallel. The results are stored in the table
+        `util.consistency_check_aggregate`, and a final task reports all failed checks together.
+
+        Args:
+            id: The id of the task
+            checks: The checks to run
+            db_alias: The database of the checked tables
+            max_number_of_parallel_tasks: How many tables to scan at most in parallel
+        """
+        super().__init__(id=id, description=f'Runs {len(checks)} consistency checks',
+                         max_number_of_parallel_tasks=max_number_of_parallel_tasks)
+        self.checks = checks
+        self.db_alias = db_alias or data_integration.config.default_db_alias()
+
+    def run_id(self) -> str:
+        """Identifies the results of this task in `util.consistency_check_aggregate`"""
+        return '/'.join(self.path())
+
+    def add_parallel_tasks(self, sub_pipeline: Pipeline) -> None:
+        aggregates_per_table = {}
+        for check in self.checks:
+            for aggregate in check.aggregates():
+                aggregates = aggregates_per_table.setdefault(aggregate.table_name, {})
+                aggregates[aggregate.sql()] = aggregate
+
+        sub_pipeline.add_initial(
+            Task(id='create_result_table', description='Creates the table for the computed aggregates',
+                 commands=[ExecuteSQL(sql_statement=f'''
+CREATE UNLOGGED TABLE IF NOT EXISTS util.consistency_check_aggregate (
+  run_id     TEXT             NOT NULL,
+  table_name TEXT             NOT NULL,
+  aggregate  TEXT             NOT NULL,
+  value      NUMERIC,
+  duration   DOUBLE PRECISION NOT NULL
+);
+
+DELETE FROM util.consistency_check_aggregate WHERE run_id = '{self.run_id()}';
+''', db_alias=self.db_alias, echo_queries=False)]))
+
+        tasks = []
+        task_ids = set()
+        for table_name, aggregates in aggregates_per_table.items():
+            # different table names can map to the same id, e.g. `a.b` and `a_b` or `Foo.x` and `foo.x`
+            task_id = base_task_id = 'compute_' + re.sub('[^a-z0-9_]', '_', table_name.lower())
+            n = 1
+            while task_id in task_ids:
+                n += 1
+                task_id = f'{base_task_id}_{n}'
+            task_ids.add(task_id)
+
+            task = Task(id=task_id,
+                        description=f'Computes {len(aggregates)} aggregates on {table_name}',
+                        commands=[_ComputeAggregates(self.db_alias, self.run_id(), table_name,
+                                                     list(aggregates.keys()))])
+            tasks.append(task)
+            sub_pipeline.add(task)
+
+        sub_pipeline.add(
+            Task(id='report', description='Reports all failed checks',
+                 commands=[_ReportChecks(self.db_alias, self.run_id(), self.checks)]),
+            upstreams=tasks)
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('db', _.tt[self.db_alias]),
+                ('checks', _.ul[[_.li[check.description, ': ', _.tt[str(check)]] for check in self.checks]])]
+
+
+class _ComputeAggregates(Command):
+    def __init__(self, db_alias: str, run_id: str, table_name: str, aggregates: [str]) -> None:
+        """Computes all aggregates of a table in one query and stores them in `util.consistency_check_aggregate`"""
+        super().__init__()
+        self.db_alias = db_alias
+        self.run_id = run_id
+        self.table_name = table_name
+        self.aggregates = aggregates
+
+    def query(self) -> str:
+        return 'SELECT\n  ' + ',\n  '.join(self.aggregates) + f'\nFROM {self.table_name}'
+
+    def run(self) -> bool:
+        start_time = time.time()
+        with mara_db.postgresql.postgres_cursor_context(self.db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute(self.query())
+            values = cursor.fetchone()
+            duration = time.time() - start_time
+            for aggregate, value in zip(self.aggregates, values):
+                cursor.execute('''
+INSERT INTO util.consistency_check_aggregate (run_id, table_name, aggregate, value, duration)
+VALUES (%s, %s, %s, %s, %s)''', (self.run_id, self.table_name, aggregate, value, duration))
+        logger.log(f'{self.table_name}: {len(self.aggregates)} aggregates in {duration:.1f} s',
+                   format=logger.Format.ITALICS)
+        return True
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('db', _.tt[self.db_alias]),
+                ('query', html.highlight_syntax(self.query(), 'sql'))]
+
+
+class _ReportChecks(Command):
+    def __init__(self, db_alias: str, run_id: str, checks: [Check]) -> None:
+        """Evaluates all checks from the computed aggregates and reports the failed ones"""
+        super().__init__()
+        self.db_alias = db_alias
+        self.run_id = run_id
+        self.checks = checks
+
+    def run(self) -> bool:
+        with mara_db.postgresql.postgres_cursor_context(self.db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute('''
+SELECT table_name, aggregate, value, duration
+FROM util.consistency_check_aggregate
+WHERE run_id = %s''', (self.run_id,))
+            results = {(table_name, aggregate): (value, duration)
+                       for table_name, aggregate, value, duration in cursor.fetchall()}
+
+        def result(aggregate: Aggregate):
+            return results[(aggregate.table_name, aggregate.sql())]
+
+        failed_checks = []
+        for check in self.checks:
+            value, duration = result(check.aggregate)
+            if isinstance(check.value, Aggregate):
+                expected_value, other_duration = result(check.value)
+                duration = max(duration, other_duration)
+            else:
+                expected_value = check.value
+            if check.succeeded(value, expected_value):
+                logger.log(f'{check.description}: ok ({duration:.1f} s)', format=logger.Format.ITALICS)
+            else:
+                failed_checks.append(f'{check.description}\n'
+                                     + f'assertion failed: {value} {check.relation} {expected_value}\n'
+                                     + f'{check} ({duration:.1f} s)')
+
+        if failed_checks:
+            logger.log(f'{len(failed_checks)} of {len(self.checks)} checks failed:\n\n' + '\n\n'.join(failed_checks),
+                       is_error=True, format=logger.Format.VERBATIM)
+            return False
+        return True
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('db', _.tt[self.db_alias])]
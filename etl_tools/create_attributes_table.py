@@ -5,9 +5,9 @@ import math
 import data_integration.config
 import data_integration.config
 import mara_db.postgresql
-import more_itertools
 from data_integration.commands.sql import ExecuteSQL
-from data_integration.pipelines import Pipeline, ParallelTask, Task
+from data_integration.pipelines import Command, Pipeline, ParallelTask, Task
+from etl_tools import run_metrics, utils
 from mara_page import _
 
 
@@ -15,7 +15,10 @@ class CreateAttributesTable(ParallelTask):
     def __init__(self, id: str, source_schema_name: str, source_table_name: str,
                  db_alias: str = None,
                  attributes_table_suffix: str = '_attributes',
-                 max_number_of_parallel_tasks: int = None) -> None:
+                 max_number_of_parallel_tasks: int = None,
+                 single_scan: bool = False,
+                 incremental: bool = False,
+                 record_metrics: bool = False) -> None:
         """
         Creates an indexed lookup table for providing fast auto-completion on the values of a table
 
@@ -35,6 +38,19 @@ class CreateAttributesTable(ParallelTask):
         b         | y     | 1
         c         | i     | 3
 
+        By default, each attribute is computed with its own `GROUP BY` query on the source table. When `single_scan`
+        is true, then the source table is read only once: slices of the table (consecutive block ranges, requires
+        PostgreSQL >= 14) are scanned in parallel and the values of all attributes are counted in the same pass.
+        The partial counts are then summed up per attribute.
+
+        When `incremental` is true and the attributes table already exists with the same attributes, then each
+        attribute is counted into a new table and compared with the fingerprint of the previous run (stored in
+        `<attributes table>_fingerprint`). Only partitions of changed attributes are replaced (and their trigram
+        indexes rebuilt), the others are left untouched.
+
+        When `record_metrics` is true, then the duration and wait time of each scan and attribute are recorded
+        (see `etl_tools.run_metrics`).
+
         Args:
             id: The id of the task
             source_schema_name: The schema of the original table, e.g. 'foo'
@@ -42,6 +58,9 @@ class CreateAttributesTable(ParallelTask):
             db_alias: The database alias for the source and attributes table
             attributes_table_suffix: This suffix will be appended to the source table name
             max_number_of_parallel_tasks: How many child tasks to run at most
+            single_scan: Whether to compute all attributes in one scan of the source table
+            incremental: Whether to only replace the partitions of attributes with changed values
+            record_metrics: Whether to record metrics of the scans and attributes
         """
         super().__init__(id,
                          description=f'Creates an attributes lookup table on {source_schema_name}.{source_table_name}.',
@@ -51,23 +70,21 @@ class CreateAttributesTable(ParallelTask):
         self.source_table_name = source_table_name
         self.attributes_table_suffix = attributes_table_suffix
         self.db_alias = db_alias or data_integration.config.default_db_alias()
+        self.single_scan = single_scan
+        self.incremental = incremental
+        self.record_metrics = record_metrics
+        self._run = None
 
     def add_parallel_tasks(self, sub_pipeline: Pipeline) -> None:
         attributes_table_name = f'{self.source_schema_name}.{self.source_table_name}{self.attributes_table_suffix}'
+        fingerprint_table_name = f'{attributes_table_name}_fingerprint'
 
-        ddl = f'''
-DROP TABLE IF EXISTS {attributes_table_name};
-
-CREATE TABLE {attributes_table_name} (
-    attribute TEXT NOT NULL, 
-    value     TEXT NOT NULL, 
-    row_count BIGINT NOT NULL
-) PARTITION BY LIST (attribute);
-'''
-
-        commands = []
+        if self.record_metrics:
+            self._run = run_metrics.start_run(self)
 
         with mara_db.postgresql.postgres_cursor_context(self.db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            pg_version = cursor.connection.server_version
+
             cursor.execute(f'''
 WITH enums AS (
     SELECT DISTINCT
@@ -84,39 +101,247 @@ FROM information_schema.columns
       AND table_name = {'%s'}
       AND (data_type IN ('text', 'varchar') OR enums.typname IS NOT NULL);
 ''', (self.source_schema_name, self.source_table_name))
+            column_names = [column_name for column_name, in cursor.fetchall()]
+
+            cursor.execute('''
+SELECT pg_relation_size(%s :: REGCLASS) / current_setting('block_size') :: BIGINT''',
+                           (f'{self.source_schema_name}.{self.source_table_name}',))
+            number_of_blocks, = cursor.fetchone()
+
+            # the number of distinct values and average width of each column, for estimating the costs of attributes
+            cursor.execute('''
+SELECT attname,
+       CASE WHEN n_distinct >= 0 THEN n_distinct ELSE -n_distinct * greatest(reltuples, 0) END,
+       avg_width,
+       greatest(reltuples, 0)
+FROM pg_stats
+  JOIN pg_namespace ON nspname = schemaname
+  JOIN pg_class ON relnamespace = pg_namespace.oid AND relname = tablename
+WHERE schemaname = %s AND tablename = %s
+ORDER BY inherited -- for tables with child tables, take the statistics that include the children''',
+                           (self.source_schema_name, self.source_table_name))
+            column_statistics = {column_name: (number_of_distinct_values, average_width, number_of_rows)
+                                 for column_name, number_of_distinct_values, average_width, number_of_rows
+                                 in cursor.fetchall()}
 
-            i = 0
+            # the partition number of each attribute when the existing attributes table can be refreshed
+            partition_numbers = None
+            if self.incremental:
+                cursor.execute('SELECT to_regclass(%s) IS NOT NULL AND to_regclass(%s) IS NOT NULL',
+                               (attributes_table_name, fingerprint_table_name))
+                if cursor.fetchone()[0]:
+                    cursor.execute(f'SELECT attribute, partition_number FROM {fingerprint_table_name}')
+                    partition_numbers = dict(cursor.fetchall())
+                    if set(partition_numbers.keys()) != set(column_names):
+                        partition_numbers = None
 
-            for column_name, in cursor.fetchall():
-                i += 1
+        if partition_numbers is None:
+            # (re-)create the attributes table with all partitions
+            partition_numbers = {column_name: i for i, column_name in enumerate(column_names, start=1)}
+            refresh = False
+            ddl = f'''
+DROP TABLE IF EXISTS {attributes_table_name};
+DROP TABLE IF EXISTS {fingerprint_table_name};
+
+CREATE TABLE {attributes_table_name} (
+    attribute TEXT NOT NULL, 
+    value     TEXT NOT NULL, 
+    row_count BIGINT NOT NULL
+) PARTITION BY LIST (attribute);
+'''
+            if self.incremental:
+                ddl += f'''
+CREATE TABLE {fingerprint_table_name} (
+    attribute        TEXT PRIMARY KEY,
+    partition_number INTEGER NOT NULL,
+    fingerprint      TEXT NOT NULL
+);
+'''
+            for column_name in column_names:
+                ddl += f"""
+CREATE TABLE {attributes_table_name}_{partition_numbers[column_name]} 
+  PARTITION OF {attributes_table_name} FOR VALUES IN ('{column_name}');
+"""
+        else:
+            refresh = True
+            ddl = ''
+
+        if self.single_scan:
+            # partitioned tables can not be unlogged, only their partitions
+            ddl += f'''
+DROP TABLE IF EXISTS {attributes_table_name}_partial;
+
+CREATE TABLE {attributes_table_name}_partial (
+    attribute TEXT NOT NULL, 
+    value     TEXT NOT NULL, 
+    row_count BIGINT NOT NULL
+) PARTITION BY LIST (attribute);
+'''
+            for column_name in column_names:
                 ddl += f"""
-CREATE TABLE {attributes_table_name}_{i} PARTITION OF {attributes_table_name} FOR VALUES IN ('{column_name}');
+CREATE UNLOGGED TABLE {attributes_table_name}_partial_{partition_numbers[column_name]} 
+  PARTITION OF {attributes_table_name}_partial FOR VALUES IN ('{column_name}');
 """
-                commands.append(
-                    ExecuteSQL(sql_statement=f'''
-INSERT INTO {attributes_table_name}_{i} 
+
+        commands = []
+
+        for column_name in column_names:
+            i = partition_numbers[column_name]
+            partition_name = f'{attributes_table_name}_{i}'
+            index_name = f'{self.source_table_name}_{self.attributes_table_suffix}_{i}__value'
+
+            if self.single_scan:
+                select_statement = f'''
+SELECT attribute, value, sum(row_count)
+FROM {attributes_table_name}_partial_{i}
+GROUP BY attribute, value
+ORDER BY value'''
+            else:
+                select_statement = f'''
 SELECT '{column_name}', "{column_name}", count(*)
 FROM {self.source_schema_name}.{self.source_table_name}
 WHERE "{column_name}" IS NOT NULL
 GROUP BY "{column_name}"
-ORDER BY "{column_name}";
+ORDER BY "{column_name}"'''
+
+            # partitions are analyzed so that `attribute_lookup` knows their number of values
+            if not refresh:
+                sql_statement = f'''
+INSERT INTO {partition_name} {select_statement};
+
+CREATE INDEX {index_name} 
+   ON {partition_name} USING GIN (value gin_trgm_ops);
+
+ANALYZE {partition_name};
+'''
+                if self.incremental:
+                    sql_statement += f'''
+INSERT INTO {fingerprint_table_name}
+SELECT '{column_name}', {i}, {_fingerprint_expression()} FROM {partition_name};
+'''
+            else:
+                # build the attribute into a new table and swap it in only when its values changed.
+                # The check constraint lets ATTACH PARTITION skip the validation scan.
+                sql_statement = f'''
+DROP TABLE IF EXISTS {partition_name}_next;
+
+CREATE TABLE {partition_name}_next (
+    attribute TEXT NOT NULL CHECK (attribute = '{column_name}'), 
+    value     TEXT NOT NULL, 
+    row_count BIGINT NOT NULL
+);
+
+INSERT INTO {partition_name}_next {select_statement};
 
-CREATE INDEX {self.source_table_name}_{self.attributes_table_suffix}_{i}__value 
-   ON {attributes_table_name}_{i} USING GIN (value gin_trgm_ops);
-''', echo_queries=False))
+DO $$
+BEGIN
+  IF (SELECT {_fingerprint_expression()} FROM {partition_name}_next)
+     IS NOT DISTINCT FROM (SELECT fingerprint FROM {fingerprint_table_name} WHERE attribute = '{column_name}') THEN
+    DROP TABLE {partition_name}_next;
+  ELSE
+    CREATE INDEX {index_name}_next 
+       ON {partition_name}_next USING GIN (value gin_trgm_ops);
 
-        sub_pipeline.add_initial(
-            Task(id='create_table', description='Creates the attributes table',
-                 commands=[ExecuteSQL(sql_statement=ddl, echo_queries=False)]))
+    ALTER TABLE {attributes_table_name} DETACH PARTITION {partition_name};
+    DROP TABLE {partition_name};
+    ALTER TABLE {partition_name}_next RENAME TO {self.source_table_name}{self.attributes_table_suffix}_{i};
+    ALTER INDEX {self.source_schema_name}.{index_name}_next RENAME TO {index_name};
+    ALTER TABLE {attributes_table_name} ATTACH PARTITION {partition_name} FOR VALUES IN ('{column_name}');
+    ANALYZE {partition_name};
 
-        chunk_size = math.ceil(len(commands) / (2 * data_integration.config.max_number_of_parallel_tasks()))
-        for n, chunk in enumerate(more_itertools.chunked(commands, chunk_size)):
+    UPDATE {fingerprint_table_name}
+    SET fingerprint = (SELECT {_fingerprint_expression()} FROM {partition_name})
+    WHERE attribute = '{column_name}';
+  END IF;
+END
+$$;
+'''
+            commands.append((self._with_metrics(ExecuteSQL(sql_statement=sql_statement, echo_queries=False),
+                                                'attribute', f'{attributes_table_name}.{column_name}'),
+                             self._estimate_cost(column_statistics.get(column_name))))
+
+        if ddl:
+            sub_pipeline.add_initial(
+                Task(id='create_table', description='Creates the attributes table',
+                     commands=[self._with_metrics(ExecuteSQL(sql_statement=ddl, echo_queries=False),
+                                                  'ddl', attributes_table_name)]))
+
+        max_number_of_parallel_tasks = (self.max_number_of_parallel_tasks
+                                        or data_integration.config.max_number_of_parallel_tasks())
+
+        scan_tasks = []
+        if self.single_scan:
+            # scan slices of the source table in parallel and count the values of all attributes in each slice
+            number_of_slices = (min(2 * max_number_of_parallel_tasks, number_of_blocks)
+                                if pg_version >= 140000 and number_of_blocks else 1)
+            values = ', '.join(f"""('{column_name}', "{column_name}" :: TEXT)""" for column_name in column_names)
+
+            for n in range(0, number_of_slices if column_names else 0):
+                conditions = ['v.value IS NOT NULL']
+                if n > 0:
+                    conditions.append(f"t.ctid >= '({number_of_blocks * n // number_of_slices},0)' :: TID")
+                if n < number_of_slices - 1:
+                    conditions.append(f"t.ctid < '({number_of_blocks * (n + 1) // number_of_slices},0)' :: TID")
+                task = Task(id=f'scan_{n}', description='Counts the values of all attributes in a slice of the table',
+                            commands=[self._with_metrics(ExecuteSQL(sql_statement=f'''
+INSERT INTO {attributes_table_name}_partial
+SELECT v.attribute, v.value, count(*)
+FROM {self.source_schema_name}.{self.source_table_name} t
+  CROSS JOIN LATERAL (VALUES {values}) v (attribute, value)
+WHERE {' AND '.join(conditions)}
+GROUP BY v.attribute, v.value;
+''', echo_queries=False), 'scan', f'{self.source_schema_name}.{self.source_table_name} slice {n}')])
+                scan_tasks.append(task)
+                sub_pipeline.add(task)
+
+        # columns without statistics (table not analyzed yet) get the average cost of the other columns
+        known_costs = [cost for _command, cost in commands if cost is not None]
+        default_cost = sum(known_costs) / len(known_costs) if known_costs else 1
+        chunks = utils.distribute_longest_first(
+            [(command, default_cost if cost is None else cost) for command, cost in commands],
+            min(len(commands), 2 * max_number_of_parallel_tasks))
+
+        for n, chunk in enumerate(chunk for chunk in chunks if chunk):
             task = Task(id=str(n), description='Process a portion of the attributes')
             task.add_commands(chunk)
-            sub_pipeline.add(task)
+            sub_pipeline.add(task, upstreams=scan_tasks)
+
+        if self.single_scan:
+            sub_pipeline.add_final(
+                Task(id='drop_partial_table', description='Removes the partial attribute counts',
+                     commands=[self._with_metrics(
+                         ExecuteSQL(sql_statement=f'DROP TABLE {attributes_table_name}_partial;', echo_queries=False),
+                         'ddl', f'{attributes_table_name}_partial')]))
+
+    def _with_metrics(self, command: Command, kind: str, name: str) -> Command:
+        """Wraps a command so that its metrics are recorded when `record_metrics` is true"""
+        return self._run.record_metrics(command, kind, name) if self._run else command
+
+    def _estimate_cost(self, statistics: (float, int, float)) -> float:
+        """
+        Estimates the relative cost of computing an attribute from the `pg_stats` of its column:
+        all rows of the table are grouped (unless they were already counted in a single scan), and the distinct
+        values are sorted and indexed, which depends on their width.
+        Returns None when there are no statistics for the column.
+        """
+        if not statistics:
+            return None
+        number_of_distinct_values, average_width, number_of_rows = statistics
+        return ((0 if self.single_scan else number_of_rows)
+                + number_of_distinct_values * math.log2(number_of_distinct_values + 2) * max(average_width or 0, 1))
 
     def html_doc_items(self) -> [(str, str)]:
         return [('db', _.tt[self.db_alias]),
                 ('source schema', _.tt[self.source_schema_name]),
                 ('source table', _.tt[self.source_table_name]),
-                ('attributes table suffix', _.tt[self.attributes_table_suffix])]
+                ('attributes table suffix', _.tt[self.attributes_table_suffix]),
+                ('single scan', _.tt[str(self.single_scan)]),
+                ('incremental', _.tt[str(self.incremental)]),
+                ('record metrics', _.tt[str(self.record_metrics)])]
+
+
+def _fingerprint_expression() -> str:
+    """An sql expression that summarizes the values and row counts of an attributes table, independent of row order"""
+    return ("count(*) || ':' || coalesce(sum(('x' || substr(md5(value || ':' || row_count), 1, 16)) "
+            ":: BIT(64) :: BIGINT :: NUMERIC), 0)")
+
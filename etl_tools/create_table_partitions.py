@@ -0,0 +1,114 @@
+"""Parallel creation of list partitions and their indexes (like `util.create_table_partitions` and `util.add_index`)"""
+
+import data_integration.config
+import mara_db.postgresql
+from data_integration.commands.sql import ExecuteSQL
+from data_integration.pipelines import Pipeline, ParallelTask, Task
+from etl_tools import utils
+from mara_page import _, html
+
+
+class CreateTablePartitions(ParallelTask):
+    def __init__(self, id: str, schema_name: str, table_name: str, key_query: str,
+                 index_column_names: [[str]] = None, index_method: str = 'btree',
+                 concurrently: bool = False, maintenance_work_mem: str = None,
+                 db_alias: str = None, max_number_of_parallel_tasks: int = None) -> None:
+        """
+        Adds for each key returned by `key_query` a list partition `<table_name>_<key>` to a partitioned table
+        and creates indexes on all partitions
+
+        Missing partitions are determined with a single catalog query and created in one task. Then the
+        missing indexes of all partitions are built in parallel tasks.
+
+        Args:
+            id: The id of the task
+            schema_name: The schema of the partitioned table, e.g. 'foo'
+            table_name: The name of the partitioned table, e.g. 'bar'
+            key_query: A query that returns the integer partition keys, e.g. 'SELECT util.get_all_chunks()'
+            index_column_names: The columns of the indexes to create on each partition, e.g. [['a'], ['b', 'c']]
+            index_method: The index method, e.g. 'btree' or 'brin'
+            concurrently: Whether to build the indexes with `CREATE INDEX CONCURRENTLY`
+            maintenance_work_mem: The `maintenance_work_mem` for each index build, e.g. '1GB'
+            db_alias: The database of the table
+            max_number_of_parallel_tasks: How many child tasks to run at most
+        """
+        super().__init__(id=id,
+                         description=f'Creates partitions and their indexes for {schema_name}.{table_name}',
+                         max_number_of_parallel_tasks=max_number_of_parallel_tasks)
+        self.schema_name = schema_name
+        self.table_name = table_name
+        self.key_query = key_query
+        self.index_column_names = index_column_names or []
+        self.index_method = index_method
+        self.concurrently = concurrently
+        self.maintenance_work_mem = maintenance_work_mem
+        self.db_alias = db_alias or data_integration.config.default_db_alias()
+
+    def add_parallel_tasks(self, sub_pipeline: Pipeline) -> None:
+        table_name = f'{self.schema_name}.{self.table_name}'
+
+        with mara_db.postgresql.postgres_cursor_context(self.db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            # all keys, whether their partition exists and the size of the partition
+            cursor.execute(f'''
+SELECT keys.key, partition.oid IS NOT NULL, coalesce(pg_relation_size(partition.oid), 0)
+FROM (SELECT DISTINCT key :: INTEGER
+      FROM ({self.key_query}) t (key)) keys
+  LEFT JOIN (SELECT pg_class.oid, pg_class.relname
+             FROM pg_inherits
+               JOIN pg_class ON pg_class.oid = pg_inherits.inhrelid
+             WHERE pg_inherits.inhparent = %s :: REGCLASS) partition
+    ON partition.relname = %s || '_' || keys.key
+ORDER BY keys.key''', (table_name, self.table_name))
+            partitions = cursor.fetchall()
+
+            # the indexes that exist already on the partitions
+            cursor.execute('''
+SELECT indexname
+FROM pg_indexes
+WHERE schemaname = %s AND tablename = ANY (%s)''',
+                           (self.schema_name, [f'{self.table_name}_{key}' for key, _exists, _size in partitions]))
+            existing_indexes = {index_name for index_name, in cursor.fetchall()}
+
+        missing_keys = [key for key, exists, _size in partitions if not exists]
+        create_task = None
+        if missing_keys:
+            create_task = Task(
+                id='create_partitions', description=f'Creates {len(missing_keys)} missing partitions',
+                commands=[ExecuteSQL(sql_statement='\n'.join(
+                    f'CREATE TABLE IF NOT EXISTS {table_name}_{key} PARTITION OF {table_name} FOR VALUES IN ({key});'
+                    for key in missing_keys), db_alias=self.db_alias, echo_queries=False)])
+            sub_pipeline.add(create_task)
+
+        index_statements = []
+        for key, _exists, size in partitions:
+            for column_names in self.index_column_names:
+                index_name = f'{self.table_name}_{key}__{"_".join(column_names)}'
+                if index_name not in existing_indexes:
+                    index_statements.append((self._index_statement(f'{table_name}_{key}', index_name, column_names),
+                                             size or 1))
+
+        number_of_tasks = min(len(index_statements), 2 * data_integration.config.max_number_of_parallel_tasks())
+        for n, statements in enumerate(utils.distribute_longest_first(index_statements, number_of_tasks)):
+            if self.maintenance_work_mem:
+                statements.insert(0, f"SET maintenance_work_mem = '{self.maintenance_work_mem}';")
+            sub_pipeline.add(
+                Task(id=f'add_indexes_{n}', description='Creates indexes on a portion of the partitions',
+                     commands=[ExecuteSQL(sql_statement='\n'.join(statements), db_alias=self.db_alias,
+                                          echo_queries=False)]),
+                upstreams=[create_task] if create_task else [])
+
+    def _index_statement(self, partition_name: str, index_name: str, column_names: [str]) -> str:
+        return ('CREATE INDEX ' + ('CONCURRENTLY ' if self.concurrently else '')
+                + f'IF NOT EXISTS "{index_name}" ON {partition_name} USING {self.index_method} '
+                + '("' + '", "'.join(column_names) + '")'
+                + (' WITH (FILLFACTOR = 100)' if self.index_method in ('btree', 'hash') else '') + ';')
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('db', _.tt[self.db_alias]),
+                ('table', _.tt[f'{self.schema_name}.{self.table_name}']),
+                ('key query', html.highlight_syntax(self.key_query, 'sql')),
+                ('indexes', _.tt[', '.join('(' + ', '.join(column_names) + ')'
+                                           for column_names in self.index_column_names)]),
+                ('index method', _.tt[self.index_method]),
+                ('concurrently', _.tt[str(self.concurrently)]),
+                ('maintenance work mem', _.tt[self.maintenance_work_mem or ''])]
@@ -4,24 +4,59 @@ from data_integration.commands.sql import ExecuteSQL
 from data_integration.pipelines import Pipeline, Task
 from etl_tools import config
 
-pipeline = Pipeline(
-    id="create_time_dimensions",
-    description="Creates a day and a duration dimension table",
-    labels={"Schema": "time"},
-    base_path=pathlib.Path(__file__).parent)
-
-pipeline.add(
-    Task(id="create_tables",
-         description="Re-creates the day and duration table and their schema",
-         commands=[
-             ExecuteSQL(sql_file_name='create_tables.sql', echo_queries=False,
-                        file_dependencies=['create_tables.sql'])
-         ]))
-
-pipeline.add(
-    Task(id="populate_time_dimensions", description="fills the time dimensions for a configured time range",
-         commands=[
-             ExecuteSQL(sql_statement=lambda: "SELECT time.populate_time_dimensions('"
-                                              + config.first_date_in_time_dimensions().isoformat() + "'::DATE, '"
-                                              + config.last_date_in_time_dimensions().isoformat() + "'::DATE);")]),
-    upstreams=['create_tables'])
+
+def time_dimensions_pipeline(incremental: bool = False) -> Pipeline:
+    """
+    Creates a pipeline that creates and fills the `time` schema
+
+    Args:
+        incremental: When true, then the schema and its tables are kept. Only days and durations that are missing
+                     in the configured range are added, and those outside of the range are removed.
+    """
+    pipeline = Pipeline(
+        id="create_time_dimensions",
+        description="Creates a day and a duration dimension table",
+        labels={"Schema": "time"},
+        base_path=pathlib.Path(__file__).parent)
+
+    if incremental:
+        pipeline.add(
+            Task(id="create_tables",
+                 description="Creates the day and duration table and their schema if they don't exist",
+                 commands=[
+                     ExecuteSQL(sql_file_name='create_tables.sql', echo_queries=False)
+                 ]))
+    else:
+        pipeline.add(
+            Task(id="create_tables",
+                 description="Re-creates the day and duration table and their schema",
+                 commands=[
+                     ExecuteSQL(sql_statement='DROP SCHEMA IF EXISTS time CASCADE;', echo_queries=False,
+                                file_dependencies=['create_tables.sql']),
+                     ExecuteSQL(sql_file_name='create_tables.sql', echo_queries=False,
+                                file_dependencies=['create_tables.sql'])
+                 ]))
+
+    pipeline.add(
+        Task(id="populate_time_dimensions", description="fills the time dimensions for a configured time range",
+             commands=[
+                 ExecuteSQL(sql_statement=lambda: "SELECT time.populate_time_dimensions('"
+                                                  + config.first_date_in_time_dimensions().isoformat() + "'::DATE, '"
+                                                  + config.last_date_in_time_dimensions().isoformat() + "'::DATE);")]),
+        upstreams=['create_tables'])
+
+    if incremental:
+        pipeline.add(
+            Task(id="trim_time_dimensions", description="removes days and durations outside of the time range",
+                 commands=[
+                     ExecuteSQL(sql_statement=lambda: "SELECT time.trim_time_dimensions('"
+                                                      + config.first_date_in_time_dimensions().isoformat()
+                                                      + "'::DATE, '"
+                                                      + config.last_date_in_time_dimensions().isoformat()
+                                                      + "'::DATE);")]),
+            upstreams=['populate_time_dimensions'])
+
+    return pipeline
+
+
+pipeline = time_dimensions_pipeline()
@@ -1,8 +1,8 @@
-DROP SCHEMA IF EXISTS time CASCADE;
-CREATE SCHEMA time;
+-- Creates the time dimension tables when they don't exist yet, can be run repeatedly
+CREATE SCHEMA IF NOT EXISTS time;
 
 
-CREATE TABLE time.day (
+CREATE TABLE IF NOT EXISTS time.day (
   day_id           INTEGER PRIMARY KEY,
   day_name         TEXT     NOT NULL UNIQUE,
   year_id          SMALLINT NOT NULL,
@@ -30,8 +30,8 @@ SELECT util.add_index('time', 'day', column_names := ARRAY ['day_of_week_id']);
 SELECT util.add_index('time', 'day', column_names := ARRAY ['day_of_month_id']);
 
 
-CREATE TABLE time.duration (
-  duration_id      INTEGER  NOT NULL,
+CREATE TABLE IF NOT EXISTS time.duration (
+  duration_id      INTEGER  PRIMARY KEY,
   days             SMALLINT NOT NULL,
   days_name        TEXT     NOT NULL,
   weeks            SMALLINT NOT NULL,
@@ -48,7 +48,6 @@ CREATE TABLE time.duration (
   years_name       TEXT     NOT NULL
 );
 
-SELECT util.add_pk('time', 'duration');
 SELECT util.add_index('time', 'duration', column_names := ARRAY ['days']);
 SELECT util.add_index('time', 'duration', column_names := ARRAY ['weeks']);
 SELECT util.add_index('time', 'duration', column_names := ARRAY ['four_weeks']);
@@ -58,7 +57,7 @@ SELECT util.add_index('time', 'duration', column_names := ARRAY ['half_years']);
 SELECT util.add_index('time', 'duration', column_names := ARRAY ['years']);
 
 
-CREATE TABLE time.hour_of_day (
+CREATE TABLE IF NOT EXISTS time.hour_of_day (
   hour_of_day_id   SMALLINT PRIMARY KEY,
   hour_of_day_name TEXT NOT NULL UNIQUE
 );
@@ -67,7 +66,8 @@ INSERT INTO time.hour_of_day
   SELECT
     h AS hour_of_day_id,
     h || '-' || h + 1
-  FROM generate_series(0, 23) h;
+  FROM generate_series(0, 23) h
+ON CONFLICT DO NOTHING;
 
 --
 -- compute all date values from start_date to now,
@@ -168,3 +168,18 @@ $$
 LANGUAGE SQL;
 
 
+--
+-- remove days and durations that are not in the date range anymore
+--
+CREATE OR REPLACE FUNCTION time.trim_time_dimensions(start_date DATE, end_date DATE)
+  RETURNS VOID AS $$
+
+DELETE FROM time.day
+WHERE _date < $1 - 1 OR _date > $2;
+
+DELETE FROM time.duration
+WHERE (duration_id < $1 - current_date - 1 OR duration_id > current_date - $1 + 2)
+      AND duration_id <> -30000;
+
+$$
+LANGUAGE SQL;
@@ -0,0 +1,118 @@
+"""Persisted durations of previous copy and index operations, used as costs for scheduling later runs"""
+
+import time
+
+import mara_db.postgresql
+from data_integration.pipelines import Command
+from etl_tools import config, utils
+
+
+def create_table_if_not_exists() -> None:
+    """Creates the table that holds the measured durations"""
+    with mara_db.postgresql.postgres_cursor_context(
+            config.duration_history_db_alias()) as cursor:  # type: psycopg2.extensions.cursor
+        cursor.execute('''
+CREATE TABLE IF NOT EXISTS etl_tools_operation_duration (
+  kind        TEXT             NOT NULL, -- e.g. 'copy' or 'index'
+  name        TEXT             NOT NULL, -- e.g. a table or index name
+  run_id      TEXT             NOT NULL, -- the run in which the operation was done
+  duration    DOUBLE PRECISION NOT NULL, -- in seconds
+  fraction    DOUBLE PRECISION NOT NULL, -- which part of the whole operation was done (e.g. a slice of a table)
+  recorded_at TIMESTAMPTZ      NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS etl_tools_operation_duration__kind_name
+  ON etl_tools_operation_duration (kind, name, recorded_at);''')
+
+
+def expected_durations(kind: str, names: [str], number_of_runs: int = 3) -> {str: float}:
+    """
+    Returns for each operation the average duration of its last `number_of_runs` runs. The duration of a run
+    is the sum of the durations of its parts, extrapolated to the whole operation when not all parts were recorded.
+    Operations without history are not included in the result.
+    """
+    if not names:
+        return {}
+    with mara_db.postgresql.postgres_cursor_context(
+            config.duration_history_db_alias()) as cursor:  # type: psycopg2.extensions.cursor
+        cursor.execute('''
+SELECT name, avg(duration)
+FROM (SELECT name, duration, row_number() OVER (PARTITION BY name ORDER BY recorded_at DESC) AS n
+      FROM (SELECT name, sum(duration) / sum(fraction) AS duration, max(recorded_at) AS recorded_at
+            FROM etl_tools_operation_duration
+            WHERE kind = %s AND name = ANY(%s)
+            GROUP BY name, run_id) runs) t
+WHERE n <= %s
+GROUP BY name''', (kind, list(names), number_of_runs))
+        return dict(cursor.fetchall())
+
+
+def record_duration(kind: str, name: str, duration: float, run_id: str, fraction: float = 1.0,
+                    number_of_runs_to_keep: int = 10) -> None:
+    """Stores the duration of (a part of) an operation in a run and removes entries of older runs of that operation"""
+    with mara_db.postgresql.postgres_cursor_context(
+            config.duration_history_db_alias()) as cursor:  # type: psycopg2.extensions.cursor
+        cursor.execute('''
+INSERT INTO etl_tools_operation_duration (kind, name, run_id, duration, fraction) VALUES (%s, %s, %s, %s, %s);
+
+DELETE FROM etl_tools_operation_duration
+WHERE kind = %s AND name = %s
+      AND run_id IN (SELECT run_id
+                     FROM etl_tools_operation_duration
+                     WHERE kind = %s AND name = %s
+                     GROUP BY run_id
+                     ORDER BY max(recorded_at) DESC
+                     OFFSET %s)''',
+                       (kind, name, run_id, duration, fraction, kind, name, kind, name, number_of_runs_to_keep))
+
+
+def estimate_costs(kind: str, sizes: {str: float}) -> {str: float}:
+    """
+    Estimates the cost (in seconds) of operations from their durations in previous runs.
+
+    For operations without history, the cost is derived from their size and the average
+    duration per size of the operations with history. When there is no history at all, the sizes are returned.
+    """
+    durations = expected_durations(kind, list(sizes.keys()))
+    size_with_history = sum(sizes[name] for name in durations)
+    if not durations or not size_with_history:
+        return {name: durations.get(name, size) for name, size in sizes.items()}
+
+    seconds_per_size = sum(durations.values()) / size_with_history
+    return {name: durations[name] if name in durations else size * seconds_per_size
+            for name, size in sizes.items()}
+
+
+class RecordDuration(Command):
+    def __init__(self, command: Command, kind: str, name: str, run_id: str, fraction: float = 1.0) -> None:
+        """
+        Runs a command and stores its duration when it succeeds
+
+        Args:
+            command: The command to run
+            kind: The kind of the operation, e.g. 'copy'
+            name: The name of the object that the operation is run on
+            run_id: Identifies the run, the durations of all parts of an operation in a run are summed up
+            fraction: Which fraction of the whole operation the command does (e.g. when copying slices of a table)
+        """
+        super().__init__()
+        self.command = command
+        self.kind = kind
+        self.name = name
+        self.run_id = run_id
+        self.fraction = fraction
+
+        self.command.parent = self
+        # expose the shell command only when the wrapped command has one (e.g. not for `StreamingCopy`)
+        if utils.has_shell_command(command):
+            self.shell_command = command.shell_command
+
+    def run(self) -> bool:
+        start_time = time.time()
+        if not self.command.run():
+            return False
+        record_duration(self.kind, self.name, time.time() - start_time, self.run_id, self.fraction)
+        return True
+
+    def html_doc_items(self) -> [(str, str)]:
+        return self.command.html_doc_items()
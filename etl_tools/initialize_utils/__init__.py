@@ -1,30 +1,60 @@
+import hashlib
 import pathlib
 
+import mara_db.postgresql
 from data_integration.commands.sql import ExecuteSQL
+from data_integration.logging import logger
 from data_integration.pipelines import Pipeline, Task
 from etl_tools import config
 
 
-def utils_pipeline(with_hll=False, with_cstore_fdw=False):
+def utils_pipeline(with_hll=False, with_cstore_fdw=False, incremental=False):
+    """
+    Creates a pipeline that creates the util schema
+
+    Args:
+        with_hll: Whether to initialize the HyperLogLog extension
+        with_cstore_fdw: Whether to initialize the cstore_fdw extension
+        incremental: When true, then the util schema is not re-created. Instead, only files that changed since
+                     their last run (content and replacements, e.g. the number of chunks) are run again
+    """
     pipeline = Pipeline(
         id="initialize_utils",
         description="Creates an utils schema with a number of functions around the ETL best practices of Project A",
         base_path=pathlib.Path(__file__).parent)
 
-    pipeline.add_initial(
-        Task(
-            id="create_utils_schema",
-            description="Re-creates the utils schema",
-            commands=[
-                ExecuteSQL(sql_statement="DROP SCHEMA IF EXISTS util CASCADE; CREATE SCHEMA util;")
-            ]))
+    if incremental:
+        pipeline.add_initial(
+            Task(
+                id="create_utils_schema",
+                description="Creates the utils schema if it does not exist",
+                commands=[
+                    ExecuteSQL(sql_statement="""
+CREATE SCHEMA IF NOT EXISTS util;
+
+CREATE TABLE IF NOT EXISTS util.sql_file_version (
+  file_name   TEXT PRIMARY KEY,
+  hash        TEXT        NOT NULL,
+  executed_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);""")
+                ]))
+    else:
+        pipeline.add_initial(
+            Task(
+                id="create_utils_schema",
+                description="Re-creates the utils schema",
+                commands=[
+                    ExecuteSQL(sql_statement="DROP SCHEMA IF EXISTS util CASCADE; CREATE SCHEMA util;")
+                ]))
+
+    command_class = ExecuteSQLIfChanged if incremental else ExecuteSQL
 
     pipeline.add(
         Task(id='chunking',
              description='Runs file chunking.sql',
              commands=[
-                 ExecuteSQL(sql_file_name='chunking.sql', echo_queries=False,
-                            replace={'number_of_chunks': lambda: config.number_of_chunks()})
+                 command_class(sql_file_name='chunking.sql', echo_queries=False,
+                               replace={'number_of_chunks': lambda: config.number_of_chunks()})
              ]))
 
     def add_task_for_file(file_name_without_extension):
@@ -32,8 +62,8 @@ def utils_pipeline(with_hll=False, with_cstore_fdw=False):
             Task(id=file_name_without_extension,
                  description=f'Runs file "{file_name_without_extension}.sql"',
                  commands=[
-                     ExecuteSQL(sql_file_name=file_name_without_extension + '.sql',
-                                echo_queries=False)
+                     command_class(sql_file_name=file_name_without_extension + '.sql',
+                                   echo_queries=False)
                  ]))
 
     for file_name_without_extension in ['consistency_checks', 'data_sets', 'partitioning',
@@ -46,4 +76,37 @@ def utils_pipeline(with_hll=False, with_cstore_fdw=False):
     if with_cstore_fdw:
         add_task_for_file('cstore_fdw')
 
-    return pipeline
\ No newline at end of file
+    return pipeline
+
+
+class ExecuteSQLIfChanged(ExecuteSQL):
+    """
+    Runs a sql file only when its content (after replacements) changed since it was last run successfully.
+    The hashes of the files are stored in `util.sql_file_version`.
+    """
+
+    def content_hash(self) -> str:
+        content = self.sql_file_path().read_text()
+        for key, value in (self.replace or {}).items():
+            content = content.replace(key, str(value() if callable(value) else value))
+        return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+    def run(self) -> bool:
+        content_hash = self.content_hash()
+
+        with mara_db.postgresql.postgres_cursor_context(self.db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute('SELECT hash FROM util.sql_file_version WHERE file_name = %s', (self.sql_file_name,))
+            row = cursor.fetchone()
+        if row and row[0] == content_hash:
+            logger.log(f'{self.sql_file_name} did not change', format=logger.Format.ITALICS)
+            return True
+
+        if not super().run():
+            return False
+
+        with mara_db.postgresql.postgres_cursor_context(self.db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute('''
+INSERT INTO util.sql_file_version (file_name, hash) VALUES (%s, %s)
+ON CONFLICT (file_name) DO UPDATE SET hash = excluded.hash, executed_at = now()''',
+                           (self.sql_file_name, content_hash))
+        return True
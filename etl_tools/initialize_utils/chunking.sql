@@ -32,12 +32,15 @@ $$ LANGUAGE SQL IMMUTABLE;
 END; $_$ LANGUAGE 'plpgsql';
 
 
--- add compute_chunk to utils schema
+-- add compute_chunk to utils schema.
+-- Existing functions (e.g. with a different number of chunks) and function indexes that use them are dropped
+DROP FUNCTION IF EXISTS util.compute_chunk(BIGINT) CASCADE;
+DROP FUNCTION IF EXISTS util.compute_chunk(TEXT) CASCADE;
 SELECT util.create_chunking_functions('util');
 
 
 -- defined chunk ids as an array
-CREATE FUNCTION util.get_all_chunks()
+CREATE OR REPLACE FUNCTION util.get_all_chunks()
   RETURNS SETOF INTEGER AS $$
 SELECT generate_series(0, number_of_chunks - 1);
 $$ LANGUAGE SQL IMMUTABLE;
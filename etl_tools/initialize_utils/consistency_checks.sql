@@ -2,7 +2,7 @@
 
 
 /** Raises an exception when a boolean expression does not evaluate to t */
-CREATE FUNCTION util.assert(description TEXT, query TEXT)
+CREATE OR REPLACE FUNCTION util.assert(description TEXT, query TEXT)
   RETURNS BOOLEAN AS $$
 DECLARE
   succeeded BOOLEAN;
@@ -22,7 +22,7 @@ LANGUAGE 'plpgsql';
 
 
 /** raises an exception when the evaluation of two number-returning queries does not satisfy the given constraint */
-CREATE FUNCTION util.assert_relation(description TEXT,
+CREATE OR REPLACE FUNCTION util.assert_relation(description TEXT,
                                      query1      TEXT, query2 TEXT,
                                      relation    TEXT)
   RETURNS BOOLEAN AS $$
@@ -51,7 +51,7 @@ LANGUAGE 'plpgsql';
 
 
 /** raises an exception when the evaluation of two number-returning queries does not lead to the same result */
-CREATE FUNCTION util.assert_equal(description TEXT, query1 TEXT, query2 TEXT)
+CREATE OR REPLACE FUNCTION util.assert_equal(description TEXT, query1 TEXT, query2 TEXT)
   RETURNS BOOLEAN AS $$
 BEGIN
   RETURN util.assert_relation(description, query1, query2, '=');
@@ -61,7 +61,7 @@ LANGUAGE 'plpgsql';
 
 
 /** raises an exception when the evaluation of two number-returning queries leads to the same result */
-CREATE FUNCTION util.assert_not_equal(description TEXT, query1 TEXT, query2 TEXT)
+CREATE OR REPLACE FUNCTION util.assert_not_equal(description TEXT, query1 TEXT, query2 TEXT)
   RETURNS BOOLEAN AS $$
 BEGIN
   RETURN util.assert_relation(description, query1, query2, '!=');
@@ -71,7 +71,7 @@ LANGUAGE 'plpgsql';
 
 
 /** raises an exception when the evaluation of query 1 is bigger than the result of query 2 */
-CREATE FUNCTION util.assert_smaller_than_or_equal(description TEXT, query1 TEXT, query2 TEXT)
+CREATE OR REPLACE FUNCTION util.assert_smaller_than_or_equal(description TEXT, query1 TEXT, query2 TEXT)
   RETURNS BOOLEAN AS $$
 BEGIN
   RETURN util.assert_relation(description, query1, query2, '<=');
@@ -81,7 +81,7 @@ LANGUAGE 'plpgsql';
 
 
 /** raises an exception when the evaluation of query is smaller than the result of query 2 */
-CREATE FUNCTION util.assert_bigger_than_or_equal(description TEXT, query1 TEXT, query2 TEXT)
+CREATE OR REPLACE FUNCTION util.assert_bigger_than_or_equal(description TEXT, query1 TEXT, query2 TEXT)
   RETURNS BOOLEAN AS $$
 BEGIN
   RETURN util.assert_relation(description, query1, query2, '>=');
@@ -91,7 +91,7 @@ LANGUAGE 'plpgsql';
 
 
 /** raises an exception when the second query returns a value that is more than a percentage different than the first one */
-CREATE FUNCTION util.assert_almost_equal(description TEXT,
+CREATE OR REPLACE FUNCTION util.assert_almost_equal(description TEXT,
                                          percentage  DECIMAL,
                                          query1      TEXT,
                                          query2      TEXT)
@@ -150,7 +150,7 @@ $$
 LANGUAGE 'plpgsql';
 
 -- raises an EXCEPTION when i_query2 returns an array with an element more than delta different from i_query1
-CREATE FUNCTION util.assert_almost_equal_array(i_description TEXT,
+CREATE OR REPLACE FUNCTION util.assert_almost_equal_array(i_description TEXT,
                                                i_query1      TEXT,
                                                i_query2      TEXT,
                                                i_delta       DECIMAL
@@ -184,7 +184,7 @@ Ads a primary key to a table
 
 Assumes that the table has a <table_name>_id column that is the primary key
 */
-CREATE FUNCTION util.add_pk(schema_name TEXT, table_name TEXT)
+CREATE OR REPLACE FUNCTION util.add_pk(schema_name TEXT, table_name TEXT)
   RETURNS VOID AS $$
 BEGIN
   EXECUTE 'ALTER TABLE ' || schema_name || '.' || table_name ||
@@ -231,7 +231,7 @@ Adds a foreign key from on table to another table
 
 Assumes that if the other table is called foo, then for foreign key has to be named foo_fk and the primary key foo_id
  */
-CREATE FUNCTION util.add_fk(source_schema_name TEXT, source_table_name TEXT,
+CREATE OR REPLACE FUNCTION util.add_fk(source_schema_name TEXT, source_table_name TEXT,
                             target_schema_name TEXT, target_table_name TEXT)
   RETURNS VOID AS $$
 SELECT util.add_fk(source_schema_name, source_table_name, target_table_name || '_fk',
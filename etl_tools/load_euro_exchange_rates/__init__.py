@@ -1,35 +1,50 @@
 import pathlib
-import os
 
-from data_integration.commands.files import ReadScriptOutput
+from data_integration.commands.python import RunFunction
 from data_integration.commands.sql import ExecuteSQL
 from data_integration.pipelines import Pipeline, Task
+from etl_tools.load_euro_exchange_rates.load_exchange_rate import load_exchange_rates
 
 
-def euro_exchange_rates_pipeline(db_alias: str):
+def euro_exchange_rates_pipeline(db_alias: str, incremental: bool = False, forward_fill_with_numpy: bool = False):
+    """
+    Creates a pipeline that loads daily Euro exchange rates
+
+    Args:
+        db_alias: The database to load the exchange rates into
+        incremental: When true, then the `euro_fx` schema is kept and only exchange rates after the last loaded
+                     date are added. Nothing is loaded when the source file did not change, and only the new
+                     days are filled in postprocessing.
+        forward_fill_with_numpy: When true, then missing days are filled in the loader with numpy (needs to be
+                                 installed) instead of in the database.
+    """
     pipeline = Pipeline(
         id="load_euro_exchange_rates",
         description="Loads daily Euro exchange rates since 1999 from the European central bank",
         base_path=pathlib.Path(__file__).parent)
 
+    commands = [] if incremental else [ExecuteSQL(sql_statement='DROP SCHEMA IF EXISTS euro_fx CASCADE;',
+                                                  db_alias=db_alias, echo_queries=False)]
+    commands.append(ExecuteSQL(sql_file_name='create_schema_and_table.sql', db_alias=db_alias, echo_queries=False))
+
     pipeline.add(
         Task(id="create_schema_and_table",
-             description="Re-creates currency exchange rate schema",
-             commands=[
-                 ExecuteSQL(sql_file_name='create_schema_and_table.sql', echo_queries=False)
-             ]))
+             description="Creates the currency exchange rate schema" if incremental
+             else "Re-creates currency exchange rate schema",
+             commands=commands))
 
     pipeline.add(
         Task(id='load_exchange_rate', description='Loads exchange rates from the European central bank',
-             commands=[ReadScriptOutput(file_name='load_exchange_rate.py', target_table='euro_fx.exchange_rate',
-                       db_alias=db_alias)]),
+             commands=[RunFunction(function=load_exchange_rates,
+                                   args=[db_alias, incremental, forward_fill_with_numpy])]),
         upstreams=['create_schema_and_table'])
 
     pipeline.add(
         Task(id="postprocess_exchange_rate",
              description="Adds values for missing days",
              commands=[
-                 ExecuteSQL(sql_file_name='postprocess_exchange_rate.sql', echo_queries=False)
+                 ExecuteSQL(sql_file_name='postprocess_exchange_rate_incremental.sql' if incremental
+                            else 'postprocess_exchange_rate.sql', db_alias=db_alias, echo_queries=False)
              ]),
         upstreams=['load_exchange_rate'])
 
@@ -1,11 +1,15 @@
-DROP SCHEMA IF EXISTS euro_fx CASCADE ;
+CREATE SCHEMA IF NOT EXISTS euro_fx;
 
-CREATE SCHEMA euro_fx;
-
-DROP TABLE IF EXISTS euro_fx.exchange_rate;
-
-CREATE TABLE euro_fx.exchange_rate (
+CREATE TABLE IF NOT EXISTS euro_fx.exchange_rate (
   currency      TEXT             NOT NULL,
   exchange_rate DOUBLE PRECISION NOT NULL,
   date          DATE             NOT NULL
-);
\ No newline at end of file
+);
+
+-- the version of the last loaded source file and the last date that was loaded from it
+CREATE TABLE IF NOT EXISTS euro_fx.exchange_rate_source (
+  source           TEXT        NOT NULL,
+  version          TEXT,
+  last_source_date DATE,
+  loaded_at        TIMESTAMPTZ NOT NULL DEFAULT now()
+);
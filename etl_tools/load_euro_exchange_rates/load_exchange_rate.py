@@ -1,24 +1,262 @@
+"""Streaming and incremental loading of Euro exchange rates from the European central bank"""
+
 import csv
+import datetime
+import hashlib
+import struct
 import sys
+import urllib.error
 import urllib.request
-import zipfile
-from io import BytesIO, StringIO
+import zlib
+
+import mara_db.postgresql
+from data_integration.logging import logger
+from etl_tools import config
 
-ZIP_FILE_URL = "https://www.ecb.europa.eu/stats/eurofxref/eurofxref-hist.zip"
-ZIP_FILE_ARCHIVE_NAME = 'eurofxref-hist.csv'
 CSV_DATE_KEY = 'Date'
 
-zipfile = zipfile.ZipFile(BytesIO(urllib.request.urlopen(ZIP_FILE_URL).read()))
-input_stream = StringIO(zipfile.read(ZIP_FILE_ARCHIVE_NAME).decode('utf-8'))
-csv_reader = csv.DictReader(input_stream, delimiter=',')
+# https://pkware.cachefly.net/webdocs/casestudies/APPNOTE.TXT, section 4.3.7
+ZIP_LOCAL_FILE_HEADER = struct.Struct('<IHHHHHIIIHH')
+ZIP_LOCAL_FILE_HEADER_SIGNATURE = 0x04034b50
+
+
+def load_exchange_rates(db_alias: str, incremental: bool = False, forward_fill_with_numpy: bool = False) -> bool:
+    """
+    Loads exchange rates from `config.euro_exchange_rates_source()` into `euro_fx.exchange_rate`
+
+    The archive is decompressed and parsed while it is downloaded. In incremental mode, the load is skipped
+    when the archive did not change since the last load (same ETag or checksum). Otherwise, only rows newer
+    than the last loaded date are read (the file is sorted by descending date) and rows that were added
+    after that date by postprocessing are deleted. Without a last loaded date, the table is truncated first.
+
+    With `forward_fill_with_numpy`, missing days and currencies are filled with the last known exchange rate before
+    loading (up to today). This needs all new rows in memory and requires numpy.
+
+    Args:
+        db_alias: The database that contains the `euro_fx` schema
+        incremental: Whether to only load new dates
+        forward_fill_with_numpy: Whether to fill missing days in the loader instead of in postprocessing
+    """
+    source = config.euro_exchange_rates_source()
+
+    with mara_db.postgresql.postgres_cursor_context(db_alias) as cursor:  # type: psycopg2.extensions.cursor
+        cursor.execute('SELECT version, last_source_date FROM euro_fx.exchange_rate_source')
+        last_version, last_source_date = cursor.fetchone() or (None, None)
+        if not incremental:
+            last_version, last_source_date = None, None
+
+        stream, version = _open_source(source, last_version)
+        if not stream:
+            logger.log(f'{source} did not change since last load', format=logger.Format.ITALICS)
+            return True
+
+        with stream:
+            rows = _exchange_rates(_csv_lines(stream),
+                                   after_date=last_source_date.isoformat() if last_source_date else None)
+            if last_source_date:
+                cursor.execute('DELETE FROM euro_fx.exchange_rate WHERE date > %s', (last_source_date,))
+            else:
+                # without a state of the last load (e.g. filled by a previous version), the whole file is loaded
+                cursor.execute('TRUNCATE euro_fx.exchange_rate')
+            if forward_fill_with_numpy:
+                rows = list(rows)
+                new_last_source_date = max((date for _currency, _exchange_rate, date in rows), default=None)
+                cursor.execute('''
+SELECT DISTINCT ON (currency) currency, exchange_rate
+FROM euro_fx.exchange_rate
+WHERE currency <> 'EUR'
+ORDER BY currency, date DESC''')
+                rows = _forward_filled(rows, dict(cursor.fetchall()),
+                                       first_date=last_source_date + datetime.timedelta(days=1)
+                                       if last_source_date else None)
+            reader = _RowReader(rows)
+            cursor.copy_expert('COPY euro_fx.exchange_rate (currency, exchange_rate, date) FROM STDIN', reader)
+
+        if not forward_fill_with_numpy:
+            new_last_source_date = reader.max_date
+        new_last_source_date = new_last_source_date or last_source_date
+        cursor.execute('''
+DELETE FROM euro_fx.exchange_rate_source;
+INSERT INTO euro_fx.exchange_rate_source (source, version, last_source_date) VALUES (%s, %s, %s)''',
+                       (source, version, new_last_source_date))
+
+    logger.log(f'{reader.number_of_rows} exchange rates '
+               + (f'after {last_source_date} ' if last_source_date else '')
+               + f'loaded from {source}', format=logger.Format.ITALICS)
+    return True
+
+
+def _open_source(source: str, last_version: str = None) -> (object, str):
+    """
+    Opens a url or local file and determines its version (ETag, Last-Modified or md5 checksum)
+
+    Returns:
+        A binary stream and the version, or `(None, version)` when the version equals `last_version`
+    """
+    if '://' in source:
+        request = urllib.request.Request(source)
+        if last_version and last_version.startswith('etag:'):
+            request.add_header('If-None-Match', last_version[len('etag:'):])
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:  # not modified
+                return None, last_version
+            raise
+        if response.headers.get('ETag'):
+            version = 'etag:' + response.headers['ETag']
+        elif response.headers.get('Last-Modified'):
+            version = 'last-modified:' + response.headers['Last-Modified']
+        else:
+            version = None
+        if version and version == last_version:
+            response.close()
+            return None, version
+        return response, version
+    else:
+        checksum = hashlib.md5()
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                checksum.update(chunk)
+        version = 'md5:' + checksum.hexdigest()
+        if version == last_version:
+            return None, version
+        return open(source, 'rb'), version
+
+
+def _csv_lines(stream, chunk_size: int = 65536) -> [str]:
+    """Yields the lines of a csv file, or of the first file in a zip archive, while reading the stream"""
+    remainder = b''
+    for data in _decompressed_chunks(stream, chunk_size):
+        lines = (remainder + data).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line.decode('utf-8')
+    if remainder:
+        yield remainder.decode('utf-8')
+
+
+def _decompressed_chunks(stream, chunk_size: int) -> [bytes]:
+    """
+    Yields the content of a stream in chunks. When the stream is a zip archive, then the first file is decompressed.
+    The archive is read from its beginning (local file header), not from its central directory at the end.
+    """
+    data = stream.read(ZIP_LOCAL_FILE_HEADER.size)
+    if len(data) < ZIP_LOCAL_FILE_HEADER.size or struct.unpack('<I', data[:4])[0] != ZIP_LOCAL_FILE_HEADER_SIGNATURE:
+        # not a zip archive
+        yield data
+        yield from iter(lambda: stream.read(chunk_size), b'')
+        return
+
+    (_signature, _version, _flags, compression_method, _time, _date, _crc, compressed_size, _uncompressed_size,
+     file_name_length, extra_field_length) = ZIP_LOCAL_FILE_HEADER.unpack(data)
+    stream.read(file_name_length + extra_field_length)
+
+    if compression_method == 0:  # stored
+        while compressed_size > 0:
+            data = stream.read(min(chunk_size, compressed_size))
+            if not data:
+                break
+            compressed_size -= len(data)
+            yield data
+    elif compression_method == 8:  # deflated
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        while not decompressor.eof:
+            data = stream.read(chunk_size)
+            if not data:
+                break
+            yield decompressor.decompress(data)
+    else:
+        raise ValueError(f'Unsupported zip compression method {compression_method}')
+
+
+def _exchange_rates(lines: [str], after_date: str = None) -> [(str, str, str)]:
+    """
+    Yields `(currency, exchange_rate, date)` tuples from the lines of the ECB csv file.
+    Stops at the first row that is not after `after_date` (an ISO date), because the file is sorted newest first.
+    """
+    for row in csv.DictReader(lines, delimiter=','):
+        date = row[CSV_DATE_KEY].strip()
+        if after_date and date <= after_date:
+            return
+        for currency, exchange_rate in row.items():
+            # all currency codes have length 3
+            if not currency or len(currency) != 3 or not exchange_rate or exchange_rate == 'N/A':
+                continue
+            yield currency, exchange_rate.strip(), date
+
+
+def _forward_filled(rows: [(str, str, str)], last_exchange_rates: {str: float},
+                    first_date: datetime.date = None) -> [(str, str, str)]:
+    """
+    Fills gaps in exchange rates with the last known exchange rate of the same currency, for all days from
+    `first_date` (or the first date in `rows`) until today
+
+    Args:
+        rows: `(currency, exchange_rate, date)` tuples
+        last_exchange_rates: The last known exchange rate for each currency before `first_date`
+        first_date: The first date to return exchange rates for
+    """
+    import numpy
+
+    currencies = sorted(set(currency for currency, _exchange_rate, _date in rows) | set(last_exchange_rates.keys()))
+    if not currencies or not (rows or first_date):
+        return
+    first_day = numpy.datetime64(first_date or min(date for _currency, _exchange_rate, date in rows), 'D')
+    number_of_days = max(int((numpy.datetime64(datetime.date.today(), 'D') - first_day).astype(int)) + 1,
+                         max((int((numpy.datetime64(date, 'D') - first_day).astype(int)) + 1
+                              for _currency, _exchange_rate, date in rows), default=0))
+    columns = {currency: column for column, currency in enumerate(currencies)}
+
+    # one row per day, one column per currency. The first row contains the last known exchange rates
+    exchange_rates = numpy.full((number_of_days + 1, len(currencies)), numpy.nan)
+    for currency, exchange_rate in last_exchange_rates.items():
+        exchange_rates[0, columns[currency]] = exchange_rate
+    for currency, exchange_rate, date in rows:
+        exchange_rates[int((numpy.datetime64(date, 'D') - first_day).astype(int)) + 1, columns[currency]] \
+            = float(exchange_rate)
+
+    # for each cell the row of the last known exchange rate
+    last_known_rows = numpy.where(numpy.isnan(exchange_rates), 0, numpy.arange(number_of_days + 1)[:, None])
+    numpy.maximum.accumulate(last_known_rows, axis=0, out=last_known_rows)
+    filled = exchange_rates[last_known_rows, numpy.arange(len(currencies))]
+
+    for day, column in zip(*numpy.nonzero(~numpy.isnan(filled[1:]))):
+        yield currencies[column], repr(float(filled[day + 1, column])), str(first_day + int(day))
+
+
+class _RowReader:
+    """A file-like object that formats rows for `COPY ... FROM STDIN` when they are read"""
+
+    def __init__(self, rows: [(str, str, str)]) -> None:
+        self.number_of_rows = 0
+        self.max_date = None
+        self._rows = iter(rows)
+        self._buffer = b''
+
+    def read(self, size: int = -1) -> bytes:
+        while size < 0 or len(self._buffer) < size:
+            row = next(self._rows, None)
+            if row is None:
+                break
+            self.number_of_rows += 1
+            currency, _exchange_rate, date = row
+            if not self.max_date or date > self.max_date:
+                self.max_date = date
+            self._buffer += ('\t'.join(row) + '\n').encode('utf-8')
+        if size < 0 or size > len(self._buffer):
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size: int = -1) -> bytes:
+        return self.read(size)
 
-csv_writer = csv.writer(sys.stdout, delimiter="\t")
 
-for row in csv_reader:
-    for currency in row.keys():
-        # all currency codes have length 3
-        if len(currency) != 3:
-            continue
-        if row[currency] == 'N/A':
-            continue
-        csv_writer.writerow([currency, row[currency], row[CSV_DATE_KEY]])
+if __name__ == '__main__':
+    # write all exchange rates as tab separated values to stdout
+    source, _version = _open_source(config.euro_exchange_rates_source())
+    with source:
+        csv_writer = csv.writer(sys.stdout, delimiter='\t')
+        for row in _exchange_rates(_csv_lines(source)):
+            csv_writer.writerow(row)
@@ -14,7 +14,8 @@ INSERT INTO euro_fx.exchange_rate
                             current_timestamp,
                             '1 day' :: INTERVAL) day
         CROSS JOIN (SELECT DISTINCT currency
-                    FROM euro_fx.exchange_rate) currency),
+                    FROM euro_fx.exchange_rate
+                    WHERE currency <> 'EUR') currency),
 
       dates_of_last_known_exchange_rates AS (
       -- find for each currency and date the last date when an exchange rates was known
@@ -62,11 +63,15 @@ INSERT INTO euro_fx.exchange_rate
   FROM (
          SELECT DISTINCT date
          FROM euro_fx.exchange_rate
+         EXCEPT
+         SELECT date
+         FROM euro_fx.exchange_rate
+         WHERE currency = 'EUR'
        ) t
   ORDER BY date;
 
 ANALYZE euro_fx.exchange_rate;
 
-CREATE INDEX exchange_rate__currency_date
+CREATE INDEX IF NOT EXISTS exchange_rate__currency_date
   ON euro_fx.exchange_rate (currency, date) WITH ( FILLFACTOR = 100 );
 
@@ -0,0 +1,70 @@
+-- Like postprocess_exchange_rate.sql, but only fills the days after the last postprocessed day.
+-- All days until the last day with an 'EUR' exchange rate are complete from previous runs.
+
+CREATE INDEX IF NOT EXISTS exchange_rate__currency_date
+  ON euro_fx.exchange_rate (currency, date) WITH ( FILLFACTOR = 100 );
+
+CREATE TEMPORARY TABLE exchange_rate_fill_start AS
+  SELECT coalesce((SELECT max(date)
+                   FROM euro_fx.exchange_rate
+                   WHERE currency = 'EUR'),
+                  (SELECT min(date) - 1
+                   FROM euro_fx.exchange_rate)) AS date;
+
+INSERT INTO euro_fx.exchange_rate
+
+  WITH missing_days_and_currencies AS (
+    -- all new days and currencies without an exchange rate
+      SELECT
+        day :: DATE AS date,
+        currency
+      FROM
+            generate_series((SELECT date + 1
+                             FROM exchange_rate_fill_start),
+                            current_timestamp,
+                            '1 day' :: INTERVAL) day
+        CROSS JOIN (SELECT DISTINCT currency
+                    FROM euro_fx.exchange_rate
+                    WHERE currency <> 'EUR') currency
+
+      EXCEPT
+
+      SELECT
+        date,
+        currency
+      FROM euro_fx.exchange_rate
+      WHERE date > (SELECT date
+                    FROM exchange_rate_fill_start))
+
+  SELECT
+    currency,
+    last_known_exchange_rate.exchange_rate,
+    date
+  FROM missing_days_and_currencies
+    CROSS JOIN LATERAL (
+               -- the last known exchange rate of the currency (uses the index on currency and date)
+               SELECT exchange_rate
+               FROM euro_fx.exchange_rate
+               WHERE exchange_rate.currency = missing_days_and_currencies.currency
+                     AND exchange_rate.date < missing_days_and_currencies.date
+               ORDER BY exchange_rate.date DESC
+               LIMIT 1) last_known_exchange_rate
+  ORDER BY currency, date;
+
+-- Insert an exchange rate of 1 for 'EUR' to simplify subsequent joins
+INSERT INTO euro_fx.exchange_rate
+  SELECT
+    'EUR' AS currency,
+    1     AS exchange_rate,
+    date
+  FROM (
+         SELECT DISTINCT date
+         FROM euro_fx.exchange_rate
+         WHERE date > (SELECT date
+                       FROM exchange_rate_fill_start)
+       ) t
+  ORDER BY date;
+
+DROP TABLE exchange_rate_fill_start;
+
+ANALYZE euro_fx.exchange_rate;
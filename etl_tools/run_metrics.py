@@ -0,0 +1,276 @@
+"""Metrics of the commands that parallel tasks generate (rows, bytes, durations, wait times), for finding out
+which table, index or attribute determined the runtime of a run and how well the workers were used"""
+
+import datetime
+import json
+import os
+import time
+
+import data_integration.config
+import mara_db.postgresql
+from data_integration.pipelines import Command, ParallelTask, Task
+from etl_tools import config, utils
+
+
+def create_tables_if_not_exist() -> None:
+    """Creates the tables and the breakdown view for the metrics in the `config.metrics_db_alias()` db"""
+    with mara_db.postgresql.postgres_cursor_context(
+            config.metrics_db_alias()) as cursor:  # type: psycopg2.extensions.cursor
+        cursor.execute('''
+CREATE TABLE IF NOT EXISTS etl_tools_run (
+  run_id                       TEXT        PRIMARY KEY, -- e.g. 'daily/copy_schema@2019-07-07T03:00:00.000000'
+  parallel_task                TEXT        NOT NULL, -- the path of the parallel task, e.g. 'daily/copy_schema'
+  max_number_of_parallel_tasks INTEGER     NOT NULL,
+  started_at                   TIMESTAMPTZ NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS etl_tools_command_metrics (
+  run_id            TEXT             NOT NULL,
+  task_id           TEXT             NOT NULL, -- the sub task that ran the command, e.g. 'copy_tables_3'
+  upstream_task_ids TEXT []          NOT NULL,
+  kind              TEXT             NOT NULL, -- e.g. 'copy', 'index' or 'attribute'
+  name              TEXT             NOT NULL, -- e.g. a table, index or column name
+  started_at        TIMESTAMPTZ      NOT NULL,
+  wait_time         DOUBLE PRECISION NOT NULL, -- seconds between the start of the run and the start of the command
+  duration          DOUBLE PRECISION NOT NULL, -- in seconds
+  number_of_rows    BIGINT,
+  number_of_bytes   BIGINT,
+  pid               INTEGER          NOT NULL, -- the process of the sub task
+  succeeded         BOOLEAN          NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS etl_tools_command_metrics__run_id
+  ON etl_tools_command_metrics (run_id);
+
+CREATE OR REPLACE VIEW etl_tools_run_breakdown AS
+SELECT run_id, parallel_task, started_at, max_number_of_parallel_tasks,
+       wall_time,
+       busy_time,
+       max_number_of_parallel_tasks * wall_time - busy_time AS idle_worker_time,
+       busy_time / nullif(max_number_of_parallel_tasks * wall_time, 0) AS utilization,
+       number_of_tasks, number_of_commands, number_of_failed_commands,
+       number_of_rows, number_of_bytes,
+       slowest_command, slowest_command_duration
+FROM (SELECT etl_tools_run.*,
+             extract(EPOCH FROM max(m.started_at + m.duration * INTERVAL '1 second') - etl_tools_run.started_at)
+               AS wall_time,
+             sum(m.duration) AS busy_time,
+             count(DISTINCT m.task_id) AS number_of_tasks,
+             count(*) AS number_of_commands,
+             count(*) FILTER (WHERE NOT m.succeeded) AS number_of_failed_commands,
+             sum(m.number_of_rows) AS number_of_rows,
+             sum(m.number_of_bytes) AS number_of_bytes,
+             (array_agg(m.kind || ' ' || m.name ORDER BY m.duration DESC))[1] AS slowest_command,
+             max(m.duration) AS slowest_command_duration
+      FROM etl_tools_run
+        JOIN etl_tools_command_metrics m USING (run_id)
+      GROUP BY etl_tools_run.run_id) t;''')
+
+
+class Run:
+    def __init__(self, run_id: str, parallel_task: str, max_number_of_parallel_tasks: int,
+                 started_at: float) -> None:
+        """A run of a parallel task whose commands record metrics (see `start_run`)"""
+        self.run_id = run_id
+        self.parallel_task = parallel_task
+        self.max_number_of_parallel_tasks = max_number_of_parallel_tasks
+        self.started_at = started_at
+
+    def record_metrics(self, command: Command, kind: str, name: str) -> 'RecordMetrics':
+        """Wraps a command so that its metrics are recorded as part of this run"""
+        return RecordMetrics(command, kind=kind, name=name, run_id=self.run_id, run_started_at=self.started_at)
+
+
+def start_run(parallel_task: ParallelTask, number_of_runs_to_keep: int = 30) -> Run:
+    """
+    Registers a new run of a parallel task, to be called in its `add_parallel_tasks`. Metrics of old runs
+    of the same parallel task are removed.
+    """
+    path = '/'.join(parallel_task.path())
+    started_at = time.time()
+    run = Run(run_id=f'{path}@{datetime.datetime.fromtimestamp(started_at).isoformat()}', parallel_task=path,
+              max_number_of_parallel_tasks=(parallel_task.max_number_of_parallel_tasks
+                                            or data_integration.config.max_number_of_parallel_tasks()),
+              started_at=started_at)
+
+    if config.metrics_db_alias():
+        create_tables_if_not_exist()
+        with mara_db.postgresql.postgres_cursor_context(
+                config.metrics_db_alias()) as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute('''
+INSERT INTO etl_tools_run (run_id, parallel_task, max_number_of_parallel_tasks, started_at)
+VALUES (%s, %s, %s, to_timestamp(%s));
+
+DELETE FROM etl_tools_command_metrics
+WHERE run_id IN (SELECT run_id
+                 FROM etl_tools_run
+                 WHERE parallel_task = %s
+                 ORDER BY started_at DESC
+                 OFFSET %s);
+
+DELETE FROM etl_tools_run
+WHERE run_id IN (SELECT run_id
+                 FROM etl_tools_run
+                 WHERE parallel_task = %s
+                 ORDER BY started_at DESC
+                 OFFSET %s)''',
+                           (run.run_id, run.parallel_task, run.max_number_of_parallel_tasks, run.started_at,
+                            path, number_of_runs_to_keep, path, number_of_runs_to_keep))
+
+    _append_to_metrics_file({'record': 'run', 'run_id': run.run_id, 'parallel_task': run.parallel_task,
+                             'max_number_of_parallel_tasks': run.max_number_of_parallel_tasks,
+                             'started_at': _isoformat(run.started_at)})
+    return run
+
+
+def record_metrics(metrics: dict) -> None:
+    """Stores the metrics of a command in the metrics db and / or appends them to the metrics file"""
+    if config.metrics_db_alias():
+        with mara_db.postgresql.postgres_cursor_context(
+                config.metrics_db_alias()) as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute('''
+INSERT INTO etl_tools_command_metrics (run_id, task_id, upstream_task_ids, kind, name, started_at, wait_time,
+                                       duration, number_of_rows, number_of_bytes, pid, succeeded)
+VALUES (%(run_id)s, %(task_id)s, %(upstream_task_ids)s, %(kind)s, %(name)s, %(started_at)s :: TIMESTAMPTZ,
+        %(wait_time)s, %(duration)s, %(number_of_rows)s, %(number_of_bytes)s, %(pid)s, %(succeeded)s)''',
+                           metrics)
+
+    _append_to_metrics_file(dict(record='command', **metrics))
+
+
+def breakdown(run_id: str) -> dict:
+    """
+    Returns a breakdown of a run from the metrics db: when each sub task ran and on which worker slot,
+    the critical path and the idle worker time.
+
+    The critical path starts with the task that finished last and then repeatedly follows the upstream that
+    finished last. For each task, `waited` is the time between the end of its last upstream (or the start of
+    the run) and its own start, i.e. the time that the task waited for a free worker.
+    Worker slots are assigned in the order in which tasks started (the lowest free slot).
+    """
+    with mara_db.postgresql.postgres_cursor_context(
+            config.metrics_db_alias()) as cursor:  # type: psycopg2.extensions.cursor
+        cursor.execute('''
+SELECT max_number_of_parallel_tasks FROM etl_tools_run WHERE run_id = %s''', (run_id,))
+        max_number_of_parallel_tasks, = cursor.fetchone()
+
+        cursor.execute('''
+SELECT task_id, upstream_task_ids, min(wait_time), max(wait_time + duration), sum(duration),
+       sum(number_of_rows), sum(number_of_bytes), bool_and(succeeded),
+       array_agg(kind || ' ' || name ORDER BY duration DESC)
+FROM etl_tools_command_metrics
+WHERE run_id = %s
+GROUP BY task_id, upstream_task_ids
+ORDER BY min(wait_time), task_id''', (run_id,))
+        tasks = {task_id: {'task_id': task_id, 'upstream_task_ids': upstream_task_ids, 'start': start, 'end': end,
+                           'duration': duration, 'number_of_rows': number_of_rows, 'number_of_bytes': number_of_bytes,
+                           'succeeded': succeeded, 'commands': commands}
+                 for task_id, upstream_task_ids, start, end, duration, number_of_rows, number_of_bytes, succeeded,
+                     commands in cursor.fetchall()}
+
+    slot_ends = []
+    for task in tasks.values():
+        upstream_ends = [tasks[upstream]['end'] for upstream in task['upstream_task_ids'] if upstream in tasks]
+        task['waited'] = task['start'] - max(upstream_ends, default=0)
+        free_slots = [slot for slot, end in enumerate(slot_ends) if end <= task['start']]
+        task['worker_slot'] = free_slots[0] if free_slots else len(slot_ends)
+        if free_slots:
+            slot_ends[task['worker_slot']] = task['end']
+        else:
+            slot_ends.append(task['end'])
+
+    critical_path = []
+    task = max(tasks.values(), key=lambda task: task['end'], default=None)
+    while task:
+        critical_path.insert(0, task['task_id'])
+        task = max((tasks[upstream] for upstream in task['upstream_task_ids'] if upstream in tasks),
+                   key=lambda task: task['end'], default=None)
+
+    wall_time = max((task['end'] for task in tasks.values()), default=0)
+    busy_time = sum(task['duration'] for task in tasks.values())
+    return {'run_id': run_id,
+            'wall_time': wall_time,
+            'busy_time': busy_time,
+            'idle_worker_time': max_number_of_parallel_tasks * wall_time - busy_time,
+            'critical_path': critical_path,
+            'tasks': list(tasks.values())}
+
+
+def _append_to_metrics_file(record: dict) -> None:
+    """Appends a record as a json line to `config.metrics_file()` (when set)"""
+    file_name = config.metrics_file()
+    if file_name:
+        # a single write of a short line in append mode, so that lines of parallel processes are not interleaved
+        with open(file_name, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+
+
+def _isoformat(timestamp: float) -> str:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).isoformat()
+
+
+def _transferred_rows_and_bytes(command: Command) -> (int, int):
+    """The number of rows and bytes that a command (or a command wrapped by it) transferred, when known"""
+    while isinstance(command, Command):
+        if hasattr(command, 'number_of_rows'):
+            return command.number_of_rows, getattr(command, 'number_of_bytes', None)
+        command = getattr(command, 'command', None) or getattr(command, 'copy_command', None)
+    return None, None
+
+
+class RecordMetrics(Command):
+    def __init__(self, command: Command, kind: str, name: str, run_id: str, run_started_at: float) -> None:
+        """
+        Runs a command and records its metrics: duration, wait time since the start of the run,
+        transferred rows and bytes (for commands that count them, e.g. `StreamingCopy`), the sub task and its
+        upstreams and the process that ran it.
+
+        Args:
+            command: The command to run
+            kind: The kind of the operation, e.g. 'copy'
+            name: The name of the object that the operation is run on
+            run_id: The run of the parallel task that the command belongs to
+            run_started_at: When the run started (unix timestamp)
+        """
+        super().__init__()
+        self.command = command
+        self.kind = kind
+        self.name = name
+        self.run_id = run_id
+        self.run_started_at = run_started_at
+
+        self.command.parent = self
+        # expose the shell command only when the wrapped command has one (e.g. not for `StreamingCopy`)
+        if utils.has_shell_command(command):
+            self.shell_command = command.shell_command
+
+    def task(self) -> Task:
+        """The sub task that runs this command"""
+        node = self.parent
+        while node is not None and not isinstance(node, Task):
+            node = node.parent
+        return node
+
+    def run(self) -> bool:
+        start_time = time.time()
+        succeeded = self.command.run()
+        duration = time.time() - start_time
+
+        task = self.task()
+        number_of_rows, number_of_bytes = _transferred_rows_and_bytes(self.command)
+        record_metrics({'run_id': self.run_id,
+                        'task_id': task.id if task else '',
+                        'upstream_task_ids': sorted(upstream.id for upstream in task.upstreams) if task else [],
+                        'kind': self.kind,
+                        'name': self.name,
+                        'started_at': _isoformat(start_time),
+                        'wait_time': start_time - self.run_started_at,
+                        'duration': duration,
+                        'number_of_rows': number_of_rows,
+                        'number_of_bytes': number_of_bytes,
+                        'pid': os.getpid(),
+                        'succeeded': bool(succeeded)})
+        return succeeded
+
+    def html_doc_items(self) -> [(str, str)]:
+        return self.command.html_doc_items()
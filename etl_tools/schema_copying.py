@@ -1,5 +1,8 @@
 """Machinery for copying whole schemas from one PostgreSQL database to another"""
 
+import datetime
+import math
+import re
 import shlex
 
 import mara_db.dbs
@@ -8,13 +11,20 @@ import mara_db.shell
 from data_integration.commands import bash
 from data_integration.commands.bash import RunBash
 from data_integration.commands.sql import ExecuteSQL
+from data_integration.logging import logger
 from data_integration.pipelines import Pipeline, Task, ParallelTask, Command
-from mara_page import _
+from etl_tools import duration_history, run_metrics, utils
+from etl_tools.streaming_copy import StreamingCopy
+from mara_page import _, html
 
 
 def add_schema_copying_to_pipeline(pipeline: Pipeline, schema_name,
                                    source_db_alias: str, target_db_alias: str,
-                                   max_number_of_parallel_tasks: int = 4):
+                                   max_number_of_parallel_tasks: int = 4,
+                                   max_table_slice_size: float = None,
+                                   binary_copy: bool = False, incremental: bool = False,
+                                   use_duration_history: bool = False, use_staging_schema: bool = False,
+                                   record_metrics: bool = False, max_number_of_parallel_cstore_copies: int = None):
     """
     Adds schema copying to the end of a pipeline.
 
@@ -27,6 +37,18 @@ def add_schema_copying_to_pipeline(pipeline: Pipeline, schema_name,
         source_db_alias: The alias of the PostgreSQL database to copy from
         target_db_alias: The alias of the PostgreSQL database to copy to
         max_number_of_parallel_tasks: How many operations to run at parallel at max.
+        max_table_slice_size: When set, tables bigger than this (in MB) are split into block range slices
+                              that are copied in parallel
+        binary_copy: When true, then table contents are streamed in binary format through pooled connections
+                     instead of through psql pipes
+        incremental: When true, then only tables that changed since the last copy are copied again
+        use_duration_history: When true, then tasks are scheduled based on the durations of previous runs
+        use_staging_schema: When true, then the schema is copied to `<schema_name>_next` on the target db and
+                            then replaces the original schema
+        record_metrics: When true, then the rows, bytes, duration and wait time of each copy and index build are
+                        recorded (see `etl_tools.run_metrics`)
+        max_number_of_parallel_cstore_copies: When set, then cstore tables are streamed in binary format in their
+                                              own tasks, with at most this many of them in parallel
     """
     task_id = "copy_schema"
     description = f"Copies the {schema_name} schema to the {target_db_alias} db"
@@ -42,14 +64,72 @@ def add_schema_copying_to_pipeline(pipeline: Pipeline, schema_name,
         ParallelCopySchema(id=task_id, description=description, schema_name=schema_name,
                            source_db_alias=source_db_alias, target_db_alias=target_db_alias,
                            max_number_of_parallel_tasks=max_number_of_parallel_tasks,
+                           max_table_slice_size=max_table_slice_size, binary_copy=binary_copy,
+                           incremental=incremental, use_duration_history=use_duration_history,
+                           use_staging_schema=use_staging_schema, record_metrics=record_metrics,
+                           max_number_of_parallel_cstore_copies=max_number_of_parallel_cstore_copies,
                            commands_before=commands[:-1], commands_after=commands[-1:]))
 
 
 class ParallelCopySchema(ParallelTask):
     def __init__(self, id: str, description: str, max_number_of_parallel_tasks: int,
                  source_db_alias: str, target_db_alias: str, schema_name: str,
+                 max_table_slice_size: float = None, binary_copy: bool = False, incremental: bool = False,
+                 use_duration_history: bool = False, use_staging_schema: bool = False,
+                 record_metrics: bool = False, max_number_of_parallel_cstore_copies: int = None,
                  commands_before: [Command] = None, commands_after: [Command] = None) -> None:
-        """In parallel copies a PostgreSQL database schema from one database to another."""
+        """
+        In parallel copies a PostgreSQL database schema from one database to another.
+
+        When `max_table_slice_size` is set, then tables bigger than this size (in MB) are split into slices of
+        consecutive blocks (ctid ranges) and each slice is copied with its own command into the same target table.
+        Slices are scheduled like normal tables, so that a single huge table does not determine the runtime
+        of the whole copy. Splitting requires PostgreSQL >= 14 on the source db (TID range scans), on older
+        versions each slice would cause a full sequential scan.
+
+        When `binary_copy` is true, then instead of piping data through two psql processes per table, the
+        data is streamed in-process with `COPY ... (FORMAT binary)` between pooled connections (see
+        `etl_tools.streaming_copy.StreamingCopy`), which saves text encoding and connection overhead.
+
+        When `incremental` is true, then the target schema is not re-created. Instead, for each table a fingerprint
+        of its structure and content (row count + sum of row hashes) is computed on the source db and compared
+        with the fingerprint of the last copy, which is kept in the `_table_fingerprint` table of the target schema.
+        Unchanged tables and their indexes are left untouched, changed tables (and tables without fingerprint whose
+        structure is the same on the target db) are truncated, copied and re-indexed, tables with a changed structure
+        are re-created. Tables that do not exist anymore on the source db are dropped, partitioned and inheritance
+        parents that are new on the source db are created. Because re-creating a table would drop dependent views,
+        schemas with views can not be copied incrementally. Changes of types, functions and of the structure of
+        parent tables are not detected, tables are not split into slices in this mode.
+
+        Table copies and index builds are distributed into `max_number_of_parallel_tasks * 3` tasks with
+        longest-processing-time-first scheduling. When `use_duration_history` is true, then the durations of all
+        copies and index builds are stored in the `etl_tools_operation_duration` table of the
+        `config.duration_history_db_alias()` db and the average of the last runs is used as cost for scheduling
+        (the slices of a table are summed up per run). Operations without history are estimated from their size
+        (see `etl_tools.duration_history`). Copies of unchanged tables and builds of existing indexes in incremental
+        mode are not recorded.
+        Indexes of a table are built as soon as all copies of that table are finished.
+
+        When `use_staging_schema` is true, then the schema is copied to a `<schema_name>_next` schema on the
+        target db, which at the end replaces the original schema with `util.replace_schema` (the function
+        needs to exist on the target db, see `initialize_utils/schema_switching.sql`). Queries on the target db
+        thus never see a partially copied schema. Can not be combined with `incremental`.
+
+        When `record_metrics` is true, then for each command of the sub tasks (schema creation, table copies and
+        index builds) the duration, the wait time since the start of the copying, the number of copied rows and
+        bytes (only with `binary_copy`) and the sub task with its upstreams are recorded in the
+        `config.metrics_db_alias()` db and / or the `config.metrics_file()` (see `etl_tools.run_metrics`).
+        The view `etl_tools_run_breakdown` and `run_metrics.breakdown` show idle worker time and the critical path.
+
+        Copying cstore tables (`relkind = 'f'`, see `initialize_utils/cstore_fdw.sql`) is CPU bound, because they
+        are decompressed on the source db and compressed again on the target db. By default they are scheduled
+        like other tables with 10 times their compressed size as cost. When `max_number_of_parallel_cstore_copies`
+        is set, then cstore tables are instead distributed into that many separate tasks, so that at most this many
+        of them are copied at the same time and the copies of row tables are not starved. They are always streamed
+        in binary format, and their costs are estimated from their compressed size and the durations of previous
+        cstore copies only (kind `copy_cstore` in the duration history). The binary instead of the text format is
+        the only CPU saving: rows are still decompressed on the source db and compressed again on the target db.
+        """
 
         ParallelTask.__init__(self, id=id, description=description,
                               max_number_of_parallel_tasks=max_number_of_parallel_tasks,
@@ -58,6 +138,22 @@ class ParallelCopySchema(ParallelTask):
         self.source_db_alias = source_db_alias
         self.target_db_alias = target_db_alias
         self.schema_name = schema_name
+        self.max_table_slice_size = max_table_slice_size
+        self.binary_copy = binary_copy
+        self.incremental = incremental
+        self.use_duration_history = use_duration_history
+        self.use_staging_schema = use_staging_schema
+        self.record_metrics = record_metrics
+        self.max_number_of_parallel_cstore_copies = max_number_of_parallel_cstore_copies
+        self._run = None
+        self._history_run_id = None
+
+        assert not (incremental and use_staging_schema), 'incremental copying can not use a staging schema'
+
+    @property
+    def target_schema_name(self) -> str:
+        """The schema on the target db into which the tables are copied"""
+        return self.schema_name + '_next' if self.use_staging_schema else self.schema_name
 
     def add_parallel_tasks(self, sub_pipeline: Pipeline) -> None:
         source_db = mara_db.dbs.db(self.source_db_alias)
@@ -65,104 +161,487 @@ class ParallelCopySchema(ParallelTask):
         assert (isinstance(source_db, mara_db.dbs.PostgreSQLDB))
         assert (isinstance(target_db, mara_db.dbs.PostgreSQLDB))
 
-        with mara_db.postgresql.postgres_cursor_context(self.source_db_alias) as cursor:
-            pg_version = cursor.connection.server_version
-
-        ddl_task = Task(
-            id='create_tables_and_functions',
-            description='Re-creates the schema, tables structure and functions on the target db',
-            commands=[
-                # schema and table structure
-                bash.RunBash(
-                    command="(echo 'DROP SCHEMA IF EXISTS " + self.schema_name + " CASCADE;';\\\n"
-                            + "    pg_dump --username=" + source_db.user + " --host=" + source_db.host
-                            + " --schema=" + self.schema_name
-                            + " --section=pre-data --no-owner --no-privileges " + source_db.database + ") \\\n"
-                            + "  | " + mara_db.shell.query_command(self.target_db_alias,
-                                                                   echo_queries=False) + ' --quiet'),
-
-                # function definitions
-                bash.RunBash(
-                    command=f'''echo "
-SELECT CONCAT(pg_get_functiondef(pg_proc.oid),';') AS def 
-FROM (SELECT oid, * 
-      FROM pg_proc p 
-      WHERE {"p.prokind in ('p','f')" if pg_version >= 110000 else "NOT p.proisagg"}) pg_proc, pg_namespace
-WHERE pg_proc.pronamespace = pg_namespace.oid
-     AND nspname = '{self.schema_name}'" \\\n'''
-                            + "  | " + mara_db.shell.copy_to_stdout_command(self.source_db_alias) + ' \\\n'
-                            + "  | " + mara_db.shell.query_command(self.target_db_alias, echo_queries=False))
-            ])
-        sub_pipeline.add(ddl_task)
-
-        # copy content of tables
-        number_of_chunks = self.max_number_of_parallel_tasks * 3
-        table_copy_chunks = {i: [] for i in range(0, number_of_chunks)}
-        current_size_per_table_copy_chunk = [0] * number_of_chunks
-        table_types = {}
+        if self.record_metrics:
+            self._run = run_metrics.start_run(self)
+        self._history_run_id = f'{"/".join(self.path())}@{datetime.datetime.now().isoformat()}'
 
         with mara_db.postgresql.postgres_cursor_context(
                 self.source_db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            pg_version = cursor.connection.server_version
+
             cursor.execute("""
 SELECT 
     pg_class.relname AS table,
     relkind,
     CASE WHEN relkind = 'f' 
-         THEN cstore_table_size(nspname || '.' || relname) * 10 -- cstore tables with similar size take longer to copy 
+         THEN cstore_table_size(nspname || '.' || relname) -- compressed size
          ELSE  pg_total_relation_size(pg_class.oid)
-    END / 1000000.0 AS size
+    END / 1000000.0 AS size,
+    CASE WHEN relkind = 'r' 
+         THEN pg_relation_size(pg_class.oid) / current_setting('block_size')::BIGINT 
+    END AS number_of_blocks
 FROM pg_class
 JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
 WHERE nspname = '""" + self.schema_name + """' AND relkind IN ('r', 'f') AND relhassubclass = 'f'
 ORDER BY size DESC""")
-            for table_name, type, size in cursor.fetchall():
-                smallest_chunk_index = min(range(len(current_size_per_table_copy_chunk)),
-                                           key=current_size_per_table_copy_chunk.__getitem__)
-                current_size_per_table_copy_chunk[smallest_chunk_index] += size
-                table_copy_chunks[smallest_chunk_index].append(table_name)
-                table_types[table_name] = type
-
-            copy_tasks = []
-            for i, tables in table_copy_chunks.items():
-                if tables:
+            tables = cursor.fetchall()
+
+            # all tables including partitioned and inheritance parents (with whether they are a parent)
+            cursor.execute("""
+SELECT relname, relkind = 'p' OR relhassubclass
+FROM pg_class
+JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+WHERE nspname = %s AND relkind IN ('r', 'f', 'p')""", (self.schema_name,))
+            source_tables = dict(cursor.fetchall())
+
+            if self.incremental:
+                cursor.execute("""
+SELECT array_agg(pg_class.oid :: REGCLASS :: TEXT)
+FROM pg_class
+JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+WHERE nspname = %s AND relkind IN ('v', 'm')""", (self.schema_name,))
+                views, = cursor.fetchone()
+                assert not views, (f'Schema {self.schema_name} has views ({", ".join(views)}), '
+                                   + 'which would be dropped when tables are re-created in incremental mode')
+
+        # in incremental mode, the schema is only re-created when it does not exist yet on the target db
+        existing_target_tables = None
+        if self.incremental:
+            with mara_db.postgresql.postgres_cursor_context(
+                    self.target_db_alias) as cursor:  # type: psycopg2.extensions.cursor
+                cursor.execute('SELECT exists(SELECT 1 FROM pg_namespace WHERE nspname = %s)', (self.schema_name,))
+                if cursor.fetchone()[0]:
+                    cursor.execute("""
+SELECT relname, relkind
+FROM pg_class
+JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
+WHERE nspname = %s AND relkind IN ('r', 'f', 'p')""", (self.schema_name,))
+                    existing_target_tables = dict(cursor.fetchall())
+
+                    # views in other schemas that depend on the tables of the schema
+                    cursor.execute("""
+SELECT array_agg(DISTINCT view.oid :: REGCLASS :: TEXT)
+FROM pg_depend
+JOIN pg_rewrite ON pg_rewrite.oid = pg_depend.objid
+JOIN pg_class view ON view.oid = pg_rewrite.ev_class
+JOIN pg_class referenced ON referenced.oid = pg_depend.refobjid
+JOIN pg_namespace ON pg_namespace.oid = referenced.relnamespace
+WHERE pg_depend.classid = 'pg_rewrite' :: REGCLASS AND pg_depend.refclassid = 'pg_class' :: REGCLASS
+      AND nspname = %s AND view.oid <> referenced.oid""", (self.schema_name,))
+                    views, = cursor.fetchone()
+                    assert not views, (f'Views {", ".join(views)} depend on tables of {self.schema_name} on the '
+                                       + 'target db, they would be dropped when tables are re-created in '
+                                       + 'incremental mode')
+
+        ddl_commands = []
+        if existing_target_tables is None:
+            # schema and table structure
+            ddl_commands.append(bash.RunBash(
+                command="(echo 'DROP SCHEMA IF EXISTS " + self.target_schema_name + " CASCADE;';\\\n"
+                        + "    " + self._pg_dump_pre_data_command() + ") \\\n"
+                        + (f"  | {self._rename_schema_command()} \\\n" if self.use_staging_schema else '')
+                        + "  | " + mara_db.shell.query_command(self.target_db_alias,
+                                                               echo_queries=False) + ' --quiet'))
+        else:
+            # remove tables that do not exist anymore on the source db (parents are compared with parents,
+            # so that partitions are not dropped together with their parent)
+            obsolete_tables = set(existing_target_tables) - set(source_tables) - {'_table_fingerprint'}
+            if obsolete_tables:
+                ddl_commands.append(ExecuteSQL(
+                    sql_statement='\n'.join(
+                        f'DROP {"FOREIGN " if existing_target_tables[table_name] == "f" else ""}TABLE IF EXISTS '
+                        f'{self.schema_name}.{table_name} CASCADE;'
+                        for table_name in sorted(obsolete_tables)),
+                    db_alias=self.target_db_alias))
+
+            # create new parent tables, so that the dumps of their new partitions can be attached to them
+            missing_parents = sorted(table_name for table_name, is_parent in source_tables.items()
+                                     if is_parent and table_name not in existing_target_tables)
+            if missing_parents:
+                ddl_commands.append(bash.RunBash(
+                    command=self._pg_dump_pre_data_command(missing_parents) + ' \\\n'
+                            + '  | ' + mara_db.shell.query_command(self.target_db_alias, echo_queries=False)
+                            + ' --quiet'))
+
+        if self.incremental:
+            ddl_commands.append(ExecuteSQL(sql_statement=f"""
+CREATE TABLE IF NOT EXISTS {self.schema_name}._table_fingerprint (
+  table_name            TEXT PRIMARY KEY,
+  structure_fingerprint TEXT NOT NULL,
+  content_fingerprint   TEXT NOT NULL
+);""", db_alias=self.target_db_alias, echo_queries=False))
+
+        # function definitions (in the staging schema, only the function name is changed, not its body)
+        function_definition = (f"regexp_replace(pg_get_functiondef(pg_proc.oid), "
+                               f"'^(CREATE OR REPLACE \\w+) {self.schema_name}\\.', '\\1 {self.target_schema_name}.')"
+                               if self.use_staging_schema else 'pg_get_functiondef(pg_proc.oid)')
+        ddl_commands.append(bash.RunBash(
+            command=f'''echo "
+SELECT CONCAT({function_definition},';') AS def 
+FROM (SELECT oid, * 
+      FROM pg_proc p 
+      WHERE {"p.prokind in ('p','f')" if pg_version >= 110000 else "NOT p.proisagg"}) pg_proc, pg_namespace
+WHERE pg_proc.pronamespace = pg_namespace.oid
+     AND nspname = '{self.schema_name}'" \\\n'''
+                    + "  | " + mara_db.shell.copy_to_stdout_command(self.source_db_alias) + ' \\\n'
+                    + "  | " + mara_db.shell.query_command(self.target_db_alias, echo_queries=False)))
+
+        ddl_task = Task(
+            id='create_tables_and_functions',
+            description='Re-creates the schema, tables structure and functions on the target db',
+            commands=[self._with_metrics(command, 'ddl', self.target_schema_name) for command in ddl_commands])
+        sub_pipeline.add(ddl_task)
+
+        if self.use_duration_history:
+            duration_history.create_table_if_not_exists()
+
+        # cstore tables are copied in their own tasks when they have their own concurrency limit
+        cstore_tables = [table_name for table_name, type, size, number_of_blocks in tables
+                         if type == 'f' and self.max_number_of_parallel_cstore_copies]
+        row_tables = [table for table in tables if table[0] not in cstore_tables]
+
+        # copy content of tables
+        number_of_chunks = self.max_number_of_parallel_tasks * 3
+        table_costs = self._estimate_costs('copy', {
+            # cstore tables with similar size take longer to copy
+            self._history_name(table_name): size * 10 if type == 'f' else size
+            for table_name, type, size, number_of_blocks in row_tables})
+        slices = []
+        for table_name, type, size, number_of_blocks in row_tables:
+            conditions = self._table_slice_conditions(type, size, number_of_blocks, pg_version,
+                                                      max_number_of_slices=number_of_chunks)
+            for condition in conditions:
+                slices.append(((table_name, condition, 1 / len(conditions)),
+                               table_costs[self._history_name(table_name)] / len(conditions)))
+
+        copy_tasks = []
+        copy_tasks_per_table = {}
+        for i, chunk in enumerate(utils.distribute_longest_first(slices, number_of_chunks)):
+            if chunk:
+                task = Task(
+                    id=f'copy_tables_{i}',
+                    description='Copies table content to the frontend db',
+                    commands=[self._copy_command(table_name, condition, fraction)
+                              for table_name, condition, fraction in chunk])
+                copy_tasks.append(task)
+                sub_pipeline.add(task, upstreams=[ddl_task])
+                for table_name, condition, fraction in chunk:
+                    copy_tasks_per_table.setdefault(table_name, set()).add(task)
+
+        if cstore_tables:
+            cstore_table_costs = self._estimate_costs('copy_cstore', {
+                self._history_name(table_name): size
+                for table_name, type, size, number_of_blocks in tables if table_name in cstore_tables})
+            for i, chunk in enumerate(utils.distribute_longest_first(
+                    [(table_name, cstore_table_costs[self._history_name(table_name)]) for table_name in cstore_tables],
+                    self.max_number_of_parallel_cstore_copies)):
+                if chunk:
                     task = Task(
-                        id=f'copy_tables_{i}',
-                        description='Copies table content to the frontend db',
-                        commands=[RunBash(
-                            command=f'echo {shlex.quote(f"COPY {self.schema_name}.{table_name} TO STDOUT")} \\\n'
-                                    + '  | ' + mara_db.shell.copy_to_stdout_command(self.source_db_alias) + ' \\\n'
-                                    + '  | ' + mara_db.shell.copy_from_stdin_command(self.target_db_alias,
-                                                                                     target_table=f'{self.schema_name}.{table_name}'))
-                            for table_name in tables])
+                        id=f'copy_cstore_tables_{i}',
+                        description='Copies cstore table content to the frontend db',
+                        commands=[self._copy_command(table_name, cstore=True) for table_name in chunk])
                     copy_tasks.append(task)
                     sub_pipeline.add(task, upstreams=[ddl_task])
+                    for table_name in chunk:
+                        copy_tasks_per_table.setdefault(table_name, set()).add(task)
 
-            # create indexes
-            index_chunks = {i: [] for i in range(0, number_of_chunks)}
-            current_size_per_index_chunk = [0] * number_of_chunks
-
-            with mara_db.postgresql.postgres_cursor_context(self.source_db_alias) as cursor:
-                cursor.execute(""" 
-SELECT indexdef AS ddl, pg_total_relation_size(pg_class.oid) AS size
+        # create indexes
+        with mara_db.postgresql.postgres_cursor_context(self.source_db_alias) as cursor:
+            cursor.execute(""" 
+SELECT pg_class.relname AS index_name, tablename, indexdef AS ddl, pg_total_relation_size(pg_class.oid) AS size
 FROM pg_class
 JOIN pg_namespace ON pg_namespace.oid = pg_class.relnamespace
 JOIN pg_indexes ON pg_indexes.indexname = pg_class.relname AND pg_indexes.schemaname = nspname
 WHERE nspname = '""" + self.schema_name + """' AND relkind = 'i'
 ORDER BY size DESC;""")
-                for ddl, size in cursor.fetchall():
-                    smallest_chunk_index = min(range(len(current_size_per_index_chunk)),
-                                               key=current_size_per_index_chunk.__getitem__)
-                    current_size_per_index_chunk[smallest_chunk_index] += size
-                    index_chunks[smallest_chunk_index].append(ddl)
-
-            for i, index_statements in index_chunks.items():
-                if index_statements:
-                    index_task = Task(id=f'add_indexes_{i}', description='Re-creates indexes on frontend db',
-                                      commands=[ExecuteSQL(sql_statement=statement, db_alias=self.target_db_alias)
-                                                for statement in index_statements])
-                    sub_pipeline.add(index_task, upstreams=copy_tasks)
+            indexes = cursor.fetchall()
+
+        index_costs = self._estimate_costs('index', {self._history_name(index_name): size
+                                                     for index_name, table_name, ddl, size in indexes})
+
+        # group indexes by the copy tasks of their tables, so that they can be built as soon as the table is copied
+        # (indexes on partitioned tables wait for all copies)
+        index_statements_per_upstreams = {}
+        for index_name, table_name, ddl, size in indexes:
+            if self.incremental:
+                # indexes of unchanged tables are kept
+                ddl = re.sub(r'^CREATE (UNIQUE )?INDEX ', r'CREATE \1INDEX IF NOT EXISTS ', ddl)
+            if self.use_staging_schema:
+                # all qualifiers, also of schema functions in expression indexes (like in `_rename_schema_command`)
+                ddl = re.sub(rf'(^|[^\w"]){re.escape(self.schema_name)}\.', rf'\g<1>{self.target_schema_name}.', ddl)
+            upstreams = frozenset(copy_tasks_per_table.get(table_name, set()))
+            index_statements_per_upstreams.setdefault(upstreams, []).append(
+                ((index_name, ddl), index_costs[self._history_name(index_name)]))
+
+        # big groups of indexes are split into several tasks
+        total_index_cost = sum(index_costs.values()) or 1
+        index_tasks = []
+        for upstreams, index_statements in index_statements_per_upstreams.items():
+            group_cost = sum(cost for statement, cost in index_statements)
+            number_of_index_chunks = max(1, min(len(index_statements),
+                                                round(number_of_chunks * group_cost / total_index_cost)))
+            for chunk in utils.distribute_longest_first(index_statements, number_of_index_chunks):
+                if chunk:
+                    index_task = Task(id=f'add_indexes_{len(index_tasks)}',
+                                      description='Re-creates indexes on frontend db',
+                                      commands=[self._index_command(index_name, statement)
+                                                for index_name, statement in chunk])
+                    index_tasks.append(index_task)
+                    sub_pipeline.add(index_task, upstreams=list(upstreams) or copy_tasks or [ddl_task])
+
+        if self.use_staging_schema:
+            sub_pipeline.add(
+                Task(id='replace_schema', description=f'Replaces the {self.schema_name} schema on the target db',
+                     commands=[self._with_metrics(
+                         ExecuteSQL(sql_statement=f"SELECT util.replace_schema('{self.schema_name}', "
+                                                  f"'{self.target_schema_name}');",
+                                    db_alias=self.target_db_alias),
+                         'ddl', self.schema_name)]),
+                upstreams=copy_tasks + index_tasks or [ddl_task])
+
+    def _history_name(self, object_name: str) -> str:
+        """The name under which the duration of operations on a table or index are stored"""
+        return f'{self.target_db_alias}:{self.schema_name}.{object_name}'
+
+    def _estimate_costs(self, kind: str, sizes: {str: float}) -> {str: float}:
+        """Estimates the costs of operations from previous durations, or from their sizes when not available"""
+        if self.use_duration_history:
+            return duration_history.estimate_costs(kind, sizes)
+        return sizes
+
+    def _index_command(self, index_name: str, statement: str) -> Command:
+        """Returns a command that creates an index on the target db"""
+        command = ExecuteSQL(sql_statement=statement, db_alias=self.target_db_alias)
+        if self.use_duration_history:
+            command = duration_history.RecordDuration(command, kind='index', name=self._history_name(index_name),
+                                                      run_id=self._history_run_id)
+        if self.incremental:
+            command = CreateIndexIfNotExists(command, schema_name=self.schema_name, index_name=index_name,
+                                             target_db_alias=self.target_db_alias)
+        return self._with_metrics(command, 'index', f'{self.target_schema_name}.{index_name}')
+
+    def _with_metrics(self, command: Command, kind: str, name: str) -> Command:
+        """Wraps a command so that its metrics are recorded when `record_metrics` is true"""
+        return self._run.record_metrics(command, kind, name) if self._run else command
+
+    def _pg_dump_pre_data_command(self, table_names: [str] = None) -> str:
+        """The shell command for dumping the structure of the schema (or of some tables) from the source db"""
+        source_db = mara_db.dbs.db(self.source_db_alias)
+        return ("pg_dump --username=" + source_db.user + " --host=" + source_db.host
+                + (f" --port={source_db.port}" if source_db.port else '')
+                + (''.join(f" --table={self.schema_name}.{table_name}" for table_name in table_names)
+                   if table_names else " --schema=" + self.schema_name)
+                + " --section=pre-data --no-owner --no-privileges " + source_db.database)
+
+    def _rename_schema_command(self) -> str:
+        """A shell command that replaces the source schema name with the target schema name in a schema dump"""
+        return 'sed -E ' + shlex.quote(
+            rf's/(^|[^[:alnum:]_"]){self.schema_name}\./\1{self.target_schema_name}./g; '
+            + rf's/SCHEMA {self.schema_name}([ ;])/SCHEMA {self.target_schema_name}\1/g')
+
+    def _table_slice_conditions(self, table_type: str, size: float, number_of_blocks: int, pg_version: int,
+                                max_number_of_slices: int) -> [str]:
+        """
+        Returns the where conditions for copying a table in slices of consecutive blocks.
+        A condition of `None` means that the whole table is copied at once.
+        """
+        if (not self.max_table_slice_size or self.incremental or table_type != 'r' or pg_version < 140000
+                or size <= self.max_table_slice_size or not number_of_blocks):
+            return [None]
+
+        number_of_slices = min(math.ceil(size / self.max_table_slice_size), max_number_of_slices, number_of_blocks)
+        boundaries = [number_of_blocks * n // number_of_slices for n in range(1, number_of_slices)]
+
+        # the first and the last slice are open-ended so that no row can be missed
+        conditions = []
+        for n in range(0, number_of_slices):
+            lower = f"ctid >= '({boundaries[n - 1]},0)'::TID" if n > 0 else None
+            upper = f"ctid < '({boundaries[n]},0)'::TID" if n < number_of_slices - 1 else None
+            conditions.append(' AND '.join(filter(None, [lower, upper])))
+        return conditions
+
+    def _copy_command(self, table_name: str, condition: str = None, fraction: float = 1.0,
+                      cstore: bool = False) -> Command:
+        """
+        Returns a command that copies a table (or the part of it that matches `condition`) to the target db.
+        With `cstore`, the table is a cstore table that is copied through the fast path for cstore tables.
+        """
+        source = (f'(SELECT * FROM {self.schema_name}.{table_name} WHERE {condition})' if condition
+                  else f'{self.schema_name}.{table_name}')
+        target_table = f'{self.target_schema_name}.{table_name}'
+        kind = 'copy_cstore' if cstore else 'copy'
+        if cstore:
+            # `COPY .. TO` does not work on foreign tables, a query does
+            command = StreamingCopy(source_db_alias=self.source_db_alias, target_db_alias=self.target_db_alias,
+                                    source=f'(SELECT * FROM {self.schema_name}.{table_name})',
+                                    target_table=target_table)
+        elif self.binary_copy:
+            command = StreamingCopy(source_db_alias=self.source_db_alias, target_db_alias=self.target_db_alias,
+                                    source=source, target_table=target_table)
+        else:
+            command = RunBash(
+                command=f'echo {shlex.quote(f"COPY {source} TO STDOUT")} \\\n'
+                        + '  | ' + mara_db.shell.copy_to_stdout_command(self.source_db_alias) + ' \\\n'
+                        + '  | ' + mara_db.shell.copy_from_stdin_command(self.target_db_alias,
+                                                                         target_table=target_table))
+        if self.use_duration_history:
+            # only the copy itself is recorded, not checking for changes
+            command = duration_history.RecordDuration(command, kind=kind, name=self._history_name(table_name),
+                                                      run_id=self._history_run_id, fraction=fraction)
+        if self.incremental:
+            command = CopyTableIfChanged(copy_command=command, table_name=table_name, schema_name=self.schema_name,
+                                         source_db_alias=self.source_db_alias, target_db_alias=self.target_db_alias,
+                                         create_table_command=RunBash(
+                                             command=self._pg_dump_pre_data_command([table_name]) + ' \\\n'
+                                                     + '  | ' + mara_db.shell.query_command(
+                                                 self.target_db_alias, echo_queries=False) + ' --quiet'))
+        return self._with_metrics(command, kind, target_table + (f' WHERE {condition}' if condition else ''))
 
     def html_doc_items(self) -> [(str, str)]:
         return [('schema', _.tt[self.schema_name]),
                 ('source db', _.tt[self.source_db_alias]),
-                ('target db', _.tt[self.target_db_alias])]
+                ('target db', _.tt[self.target_db_alias]),
+                ('max table slice size', _.tt[f'{self.max_table_slice_size} MB' if self.max_table_slice_size
+                                              else 'tables are not split']),
+                ('copy format', _.tt['binary (streamed)' if self.binary_copy else 'text (psql pipes)']),
+                ('incremental', _.tt[str(self.incremental)]),
+                ('use duration history', _.tt[str(self.use_duration_history)]),
+                ('record metrics', _.tt[str(self.record_metrics)]),
+                ('max parallel cstore copies', _.tt[str(self.max_number_of_parallel_cstore_copies)
+                                                    if self.max_number_of_parallel_cstore_copies
+                                                    else 'scheduled like other tables']),
+                ('target schema', _.tt[self.target_schema_name])]
+
+
+class CopyTableIfChanged(Command):
+    def __init__(self, copy_command: Command, create_table_command: Command, schema_name: str, table_name: str,
+                 source_db_alias: str, target_db_alias: str) -> None:
+        """
+        Runs `copy_command` only when the structure or the content of a table changed since the last copy.
+
+        Content fingerprints of the last copy are kept in the `_table_fingerprint` table of the target schema, the
+        structure (kind of table, column names and types) is compared with the existing table on the target db.
+        When the structure is the same, then the table is truncated and its indexes are dropped (they are re-created
+        by the downstream index tasks). Otherwise the table is dropped and re-created with `create_table_command`.
+        """
+        super().__init__()
+        self.copy_command = copy_command
+        self.create_table_command = create_table_command
+        self.schema_name = schema_name
+        self.table_name = table_name
+        self.source_db_alias = source_db_alias
+        self.target_db_alias = target_db_alias
+
+        self.copy_command.parent = self
+        self.create_table_command.parent = self
+
+    def structure_fingerprint_expression(self) -> str:
+        """An sql expression that summarizes the kind and the columns of the table (NULL when it does not exist)"""
+        return f"""(SELECT md5(relkind || ': ' || string_agg(attname || ' ' || format_type(atttypid, atttypmod), ', '
+                                                    ORDER BY attnum))
+   FROM pg_class
+   JOIN pg_attribute ON attrelid = pg_class.oid
+   WHERE pg_class.oid = to_regclass('{self.schema_name}.{self.table_name}') AND attnum > 0 AND NOT attisdropped
+   GROUP BY relkind)"""
+
+    def fingerprint_query(self) -> str:
+        return f"""
+SELECT 
+  {self.structure_fingerprint_expression()},
+  count(*) || ':' || coalesce(sum(('x' || substr(md5(t :: TEXT), 1, 16)) :: BIT(64) :: BIGINT :: NUMERIC), 0)
+FROM {self.schema_name}.{self.table_name} t"""
+
+    def run(self) -> bool:
+        with mara_db.postgresql.postgres_cursor_context(
+                self.source_db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute(self.fingerprint_query())
+            structure_fingerprint, content_fingerprint = cursor.fetchone()
+
+        with mara_db.postgresql.postgres_cursor_context(
+                self.target_db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute(f"""
+SELECT 
+  {self.structure_fingerprint_expression()},
+  (SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)),
+  (SELECT content_fingerprint FROM {self.schema_name}._table_fingerprint WHERE table_name = %s)""",
+                           (f'{self.schema_name}.{self.table_name}', self.table_name))
+            target_structure_fingerprint, target_relkind, last_content_fingerprint = cursor.fetchone()
+
+        same_structure = target_structure_fingerprint == structure_fingerprint
+        if same_structure and last_content_fingerprint == content_fingerprint:
+            logger.log(f'{self.schema_name}.{self.table_name} is unchanged', format=logger.Format.ITALICS)
+            return True
+
+        with mara_db.postgresql.postgres_cursor_context(
+                self.target_db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute(f'DELETE FROM {self.schema_name}._table_fingerprint WHERE table_name = %s',
+                           (self.table_name,))
+            if same_structure:
+                logger.log(f'{self.schema_name}.{self.table_name} changed', format=logger.Format.ITALICS)
+                # indexes of partitions that belong to an index of the parent table can not be dropped
+                cursor.execute(f"""
+SELECT string_agg('DROP INDEX ' || indexrelid :: REGCLASS || ';', ' ')
+FROM pg_index
+WHERE indrelid = '{self.schema_name}.{self.table_name}' :: REGCLASS
+      AND NOT exists(SELECT 1 FROM pg_constraint WHERE conindid = indexrelid)
+      AND NOT exists(SELECT 1 FROM pg_inherits WHERE inhrelid = indexrelid)""")
+                drop_indexes, = cursor.fetchone()
+                if drop_indexes:
+                    cursor.execute(drop_indexes)
+                cursor.execute(f'TRUNCATE {self.schema_name}.{self.table_name}')
+            elif target_relkind:
+                logger.log(f'The structure of {self.schema_name}.{self.table_name} changed',
+                           format=logger.Format.ITALICS)
+                cursor.execute(f'DROP {"FOREIGN " if target_relkind == "f" else ""}TABLE '
+                               f'{self.schema_name}.{self.table_name} CASCADE')
+            else:
+                logger.log(f'{self.schema_name}.{self.table_name} is new', format=logger.Format.ITALICS)
+
+        if not same_structure:
+            if not self.create_table_command.run():
+                return False
+
+        if not self.copy_command.run():
+            return False
+
+        with mara_db.postgresql.postgres_cursor_context(
+                self.target_db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute(f"""
+INSERT INTO {self.schema_name}._table_fingerprint (table_name, structure_fingerprint, content_fingerprint) 
+VALUES (%s, %s, %s)""", (self.table_name, structure_fingerprint, content_fingerprint))
+        return True
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('table', _.tt[f'{self.schema_name}.{self.table_name}']),
+                ('fingerprint query', html.highlight_syntax(self.fingerprint_query(), 'sql'))] \
+               + self.copy_command.html_doc_items()
+
+
+class CreateIndexIfNotExists(Command):
+    def __init__(self, command: Command, schema_name: str, index_name: str, target_db_alias: str) -> None:
+        """
+        Runs `command` (that creates an index) only when the index does not exist on the target db, so that
+        indexes of unchanged tables are neither re-created nor recorded in the duration history
+        """
+        super().__init__()
+        self.command = command
+        self.schema_name = schema_name
+        self.index_name = index_name
+        self.target_db_alias = target_db_alias
+
+        self.command.parent = self
+        # expose the shell command only when the wrapped command has one (e.g. not for `StreamingCopy`)
+        if utils.has_shell_command(command):
+            self.shell_command = command.shell_command
+
+    def run(self) -> bool:
+        with mara_db.postgresql.postgres_cursor_context(
+                self.target_db_alias) as cursor:  # type: psycopg2.extensions.cursor
+            cursor.execute('SELECT to_regclass(%s) IS NOT NULL', (f'{self.schema_name}."{self.index_name}"',))
+            if cursor.fetchone()[0]:
+                logger.log(f'{self.schema_name}.{self.index_name} exists', format=logger.Format.ITALICS)
+                return True
+        return self.command.run()
+
+    def html_doc_items(self) -> [(str, str)]:
+        return self.command.html_doc_items()
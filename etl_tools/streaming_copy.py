@@ -0,0 +1,160 @@
+"""Streaming of PostgreSQL COPY data between two databases without shell pipes"""
+
+import queue
+import threading
+import time
+
+from data_integration.logging import logger
+from data_integration.pipelines import Command
+from etl_tools.connection_pooling import pooled_cursor_context
+from mara_page import _, html
+
+
+class BoundedBuffer:
+    """
+    A file-like object that connects one writing and one reading thread.
+
+    Written data is collected into chunks of `chunk_size` bytes, and at most `max_number_of_chunks` chunks are
+    kept in memory. The writer blocks when the reader is too slow.
+    """
+
+    def __init__(self, chunk_size: int = 65536, max_number_of_chunks: int = 16) -> None:
+        self.chunk_size = chunk_size
+        self.number_of_bytes = 0
+
+        self._queue = queue.Queue(maxsize=max_number_of_chunks)
+        self._write_buffer = bytearray()
+        self._read_buffer = bytearray()
+        self._end_of_data = False
+        self._writer_error = None
+        self._aborted = False
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._write_buffer += data
+        self.number_of_bytes += len(data)
+        if len(self._write_buffer) >= self.chunk_size:
+            self._put(bytes(self._write_buffer))
+            self._write_buffer.clear()
+        return len(data)
+
+    def close_writing(self, error: Exception = None) -> None:
+        """Signals the end of the data. When `error` is given, then the reader will raise it"""
+        if self._aborted:
+            return
+        if self._write_buffer and not error:
+            self._put(bytes(self._write_buffer))
+            self._write_buffer.clear()
+        self._writer_error = error
+        self._put(None)
+
+    def abort(self) -> None:
+        """Called by the reader to make a blocked writer fail"""
+        self._aborted = True
+
+    def read(self, size: int = -1) -> bytes:
+        while not self._end_of_data and (size < 0 or len(self._read_buffer) < size):
+            chunk = self._queue.get()
+            if chunk is None:
+                self._end_of_data = True
+                if self._writer_error:
+                    raise self._writer_error
+            else:
+                self._read_buffer += chunk
+
+        if size < 0 or size > len(self._read_buffer):
+            size = len(self._read_buffer)
+        data = bytes(self._read_buffer[:size])
+        del self._read_buffer[:size]
+        return data
+
+    def _put(self, chunk) -> None:
+        while True:
+            if self._aborted:
+                raise IOError('Reader of buffer aborted')
+            try:
+                self._queue.put(chunk, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+
+class StreamingCopy(Command):
+    def __init__(self, source_db_alias: str, target_db_alias: str, source: str, target_table: str,
+                 binary: bool = True, chunk_size: int = 65536, max_number_of_chunks: int = 16) -> None:
+        """
+        Copies data from one PostgreSQL database to another by streaming `COPY ... TO STDOUT` on a pooled source
+        connection directly into `COPY ... FROM STDIN` on a pooled target connection.
+
+        Args:
+            source_db_alias: The database to copy from
+            target_db_alias: The database to copy to
+            source: A table name or a query in parenthesis, e.g. `(SELECT * FROM foo.bar WHERE x > 0)`
+            target_table: The table to copy to
+            binary: When true, then the binary COPY format is used (requires identical column types)
+            chunk_size: The size of in-memory buffer chunks in bytes
+            max_number_of_chunks: How many chunks to keep at most in memory
+        """
+        super().__init__()
+        self.source_db_alias = source_db_alias
+        self.target_db_alias = target_db_alias
+        self.source = source
+        self.target_table = target_table
+        self.binary = binary
+        self.chunk_size = chunk_size
+        self.max_number_of_chunks = max_number_of_chunks
+
+        self.number_of_rows = None
+        self.number_of_bytes = None
+
+    def copy_to_statement(self) -> str:
+        return f'COPY {self.source} TO STDOUT' + (' (FORMAT binary)' if self.binary else '')
+
+    def copy_from_statement(self) -> str:
+        return f'COPY {self.target_table} FROM STDIN' + (' (FORMAT binary)' if self.binary else '')
+
+    def run(self) -> bool:
+        buffer = BoundedBuffer(chunk_size=self.chunk_size, max_number_of_chunks=self.max_number_of_chunks)
+
+        def copy_to_buffer():
+            try:
+                with pooled_cursor_context(self.source_db_alias) as cursor:  # type: psycopg2.extensions.cursor
+                    cursor.copy_expert(self.copy_to_statement(), buffer, size=self.chunk_size)
+            except Exception as e:
+                buffer.close_writing(error=e)
+            else:
+                buffer.close_writing()
+
+        start_time = time.time()
+        source_thread = threading.Thread(target=copy_to_buffer, daemon=True)
+        source_thread.start()
+
+        try:
+            with pooled_cursor_context(self.target_db_alias) as cursor:  # type: psycopg2.extensions.cursor
+                cursor.copy_expert(self.copy_from_statement(), buffer, size=self.chunk_size)
+                number_of_rows = cursor.rowcount
+        except Exception as e:
+            buffer.abort()
+            source_thread.join()
+            logger.log(f'Copying {self.source} to {self.target_table} failed: {e}', is_error=True,
+                       format=logger.Format.VERBATIM)
+            return False
+
+        source_thread.join()
+        duration = max(time.time() - start_time, 0.001)
+
+        self.number_of_rows = number_of_rows if number_of_rows >= 0 else None
+        self.number_of_bytes = buffer.number_of_bytes
+        logger.log(f'{self.target_table}: '
+                   + (f'{self.number_of_rows} rows, ' if self.number_of_rows is not None else '')
+                   + f'{self.number_of_bytes / 1000000:.1f} MB in {duration:.1f} s ('
+                   + (f'{self.number_of_rows / duration:.0f} rows/s, ' if self.number_of_rows is not None else '')
+                   + f'{self.number_of_bytes / 1000000 / duration:.1f} MB/s)', format=logger.Format.ITALICS)
+        return True
+
+    def html_doc_items(self) -> [(str, str)]:
+        return [('source db', _.tt[self.source_db_alias]),
+                ('target db', _.tt[self.target_db_alias]),
+                ('copy to', html.highlight_syntax(self.copy_to_statement(), 'sql')),
+                ('copy from', html.highlight_syntax(self.copy_from_statement(), 'sql'))]
@@ -1,6 +1,35 @@
+import heapq
+
+from data_integration.pipelines import Command
 from etl_tools import config
 
 
 def chunk_parameter_function() -> [(str)]:
     """Returns all chunks. Meant to be used in chunking-based parallel tasks"""
-    return [(chunk,) for chunk in range(0, config.number_of_chunks())]
\ No newline at end of file
+    return [(chunk,) for chunk in range(0, config.number_of_chunks())]
+
+
+def distribute_longest_first(items: [(object, float)], number_of_buckets: int) -> [[object]]:
+    """
+    Distributes items with a cost into buckets so that the maximum cost per bucket is small
+    (longest-processing-time-first scheduling: the most expensive item goes into the currently cheapest bucket)
+
+    Args:
+        items: A list of `(item, cost)` tuples
+        number_of_buckets: Into how many buckets to distribute the items
+
+    Returns:
+        A list of `number_of_buckets` lists of items, some of them possibly empty
+    """
+    buckets = [[] for _ in range(0, number_of_buckets)]
+    heap = [(0, i) for i in range(0, number_of_buckets)]
+    for item, cost in sorted(items, key=lambda item_and_cost: item_and_cost[1], reverse=True):
+        bucket_cost, i = heapq.heappop(heap)
+        buckets[i].append(item)
+        heapq.heappush(heap, (bucket_cost + cost, i))
+    return buckets
+
+
+def has_shell_command(command: Command) -> bool:
+    """Whether a command implements `shell_command` (commands that run in python, e.g. `StreamingCopy`, do not)"""
+    return 'shell_command' in vars(command) or type(command).shell_command is not Command.shell_command
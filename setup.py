@@ -21,6 +21,11 @@ setup(
         'data_integration>=2.0.0',
     ],
 
+    extras_require={
+        # `etl_tools.chunking` and `forward_fill_with_numpy` in the exchange rates pipeline
+        'numpy': ['numpy'],
+    },
+
     python_requires='>=3.6',
 
     packages=find_packages(),
@@ -0,0 +1,136 @@
+"""Pins `etl_tools.chunking` to the results of `util.compute_chunk` from initialize_utils/chunking.sql"""
+
+import contextlib
+import hashlib
+import threading
+
+import pytest
+
+# `etl_tools.chunking` needs the mara packages from `install_requires`
+pytest.importorskip('data_integration')
+pytest.importorskip('mara_db')
+
+from etl_tools import chunking
+from etl_tools.chunking import _copy_line, compute_chunk, compute_chunks
+
+# `util.compute_chunk(BIGINT)` is `coalesce(abs(x) % number_of_chunks, 0)`
+BIGINT_CHUNKS = [
+    # key, chunk with 7 chunks, chunk with 1000 chunks
+    (0, 0, 0),
+    (1, 1, 1),
+    (6, 6, 6),
+    (7, 0, 7),
+    (-7, 0, 7),
+    (-15, 1, 15),
+    (123456789, 1, 789),
+    (-123456789, 1, 789),
+    (2 ** 63 - 1, 0, 807),
+    (-(2 ** 63 - 1), 0, 807),
+]
+
+# `util.compute_chunk(TEXT)` is `compute_chunk(abs(('x' || substr(md5(x), 1, 8)) :: BIT(32) :: INT))`
+TEXT_CHUNKS = [
+    # key, first 8 hex digits of md5, chunk with 7 chunks, chunk with 1000 chunks
+    ('', 'd41d8cd9', 0, 903),  # -736260903
+    ('a', '0cc175b9', 1, 177),  # 214005177
+    ('abc', '90015098', 2, 24),  # -1878962024
+    ('foo', 'acbd18db', 0, 477),  # -1396893477
+    ('Müller', 'e35bc0a7', 4, 169),  # -480526169 (md5 of the utf-8 bytes)
+]
+
+
+@pytest.mark.parametrize('key, chunk_7, chunk_1000', BIGINT_CHUNKS)
+def test_bigint(key, chunk_7, chunk_1000):
+    assert compute_chunk(key, 7) == chunk_7
+    assert compute_chunk(key, 1000) == chunk_1000
+
+
+@pytest.mark.parametrize('key, md5_prefix, chunk_7, chunk_1000', TEXT_CHUNKS)
+def test_text(key, md5_prefix, chunk_7, chunk_1000):
+    assert hashlib.md5(key.encode('utf-8')).hexdigest()[:8] == md5_prefix
+    assert compute_chunk(key, 7) == chunk_7
+    assert compute_chunk(key, 1000) == chunk_1000
+
+
+def test_null():
+    assert compute_chunk(None, 7) == 0
+
+
+def test_out_of_range():
+    with pytest.raises(ValueError):
+        compute_chunk(-2 ** 63, 7)
+    with pytest.raises(ValueError):
+        compute_chunk(2 ** 63, 7)
+
+
+def test_vectorized():
+    numpy = pytest.importorskip('numpy')
+
+    keys = [key for key, *_chunks in BIGINT_CHUNKS]
+    assert compute_chunks(keys, 7).tolist() == [chunk_7 for _key, chunk_7, _chunk_1000 in BIGINT_CHUNKS]
+    assert compute_chunks(numpy.array(keys, dtype=numpy.int64), 1000).tolist() \
+           == [chunk_1000 for _key, _chunk_7, chunk_1000 in BIGINT_CHUNKS]
+    assert compute_chunks([None, 7, None], 7).tolist() == [0, 0, 0]
+
+    keys = [key for key, *_chunks in TEXT_CHUNKS] + [None]
+    assert compute_chunks(keys, 7).tolist() == [chunk_7 for _key, _md5, chunk_7, _chunk_1000 in TEXT_CHUNKS] + [0]
+
+
+def test_vectorized_out_of_range():
+    numpy = pytest.importorskip('numpy')
+
+    with pytest.raises(ValueError):
+        compute_chunks(numpy.array([1, 2 ** 63], dtype=numpy.uint64), 7)
+    with pytest.raises(ValueError):
+        compute_chunks(numpy.array([-2 ** 63], dtype=numpy.int64), 7)
+    with pytest.raises(ValueError):
+        compute_chunks([1, 2 ** 63], 7)
+
+
+def test_copy_line_null_and_escaping():
+    assert _copy_line((None, 'a\tb', 'c\nd\re', 'f\\g', '')) == '\\N\ta\\tb\tc\\nd\\re\tf\\\\g\t\n'
+
+
+def test_copy_line_types():
+    assert _copy_line((1, 1.5, True, False)) == '1\t1.5\tt\tf\n'
+    assert _copy_line(({'a': 1, 'b': [None, 'x']},)) == '{"a": 1, "b": [null, "x"]}\n'
+    assert _copy_line((b'\x00x', bytearray(b'\xff'))) == '\\\\x0078\t\\\\xff\n'
+
+
+def test_copy_line_arrays():
+    assert _copy_line(([1, 2], [], ('a', None))) == '{"1","2"}\t{}\t{"a",NULL}\n'
+    # quotes and backslashes are escaped in the array literal, and the backslashes again for COPY
+    assert _copy_line((['a"b', 'c\\d'],)) == '{"a\\\\"b","c\\\\\\\\d"}\n'
+    assert _copy_line(([[1, 2], [3, None]], [True, b'x'])) == '{{"1","2"},{"3",NULL}}\t{"t","\\\\\\\\x78"}\n'
+
+
+def test_copy_rows_into_chunks(monkeypatch):
+    pytest.importorskip('numpy')
+
+    copied = {}
+    lock = threading.Lock()
+
+    class Cursor:
+        def copy_expert(self, statement, file):
+            data = file.read()
+            with lock:
+                copied[statement] = data.decode('utf-8')
+
+    @contextlib.contextmanager
+    def cursor_context(db_alias):
+        yield Cursor()
+
+    monkeypatch.setattr(chunking.mara_db.postgresql, 'postgres_cursor_context', cursor_context)
+
+    rows = [(1, 'a'), (7, {'b': True}), (-15, None), (None, [1, 2]), ('abc', b'x')]
+    assert chunking.copy_rows_into_chunks('db', 'foo.bar', rows, key_column_index=0, column_names=['id', 'value'],
+                                          number_of_chunks=7, batch_size=2) == 5
+
+    # with 7 chunks: 1 -> 1, 7 -> 0, -15 -> 1, None -> 0, 'abc' -> 2
+    assert copied == {'COPY foo.bar_0 (id, value) FROM STDIN': '7\t{"b": true}\n\\N\t{"1","2"}\n',
+                      'COPY foo.bar_1 (id, value) FROM STDIN': '1\ta\n-15\t\\N\n',
+                      'COPY foo.bar_2 (id, value) FROM STDIN': 'abc\t\\\\x78\n',
+                      'COPY foo.bar_3 (id, value) FROM STDIN': '',
+                      'COPY foo.bar_4 (id, value) FROM STDIN': '',
+                      'COPY foo.bar_5 (id, value) FROM STDIN': '',
+                      'COPY foo.bar_6 (id, value) FROM STDIN': ''}